@@ -0,0 +1,340 @@
+#! /usr/bin/env python
+
+"""
+Benchmarks of subtex.py on generated LaTeX projects.
+
+A synthetic project is generated with a chain of nested `\\input` files,
+figures using every custom figure macro subtex knows about, a supporting
+information section, and a large bib file. Then `SubmissionBundler.bundle`
+(with several option combinations), `copy_latex_file` and
+`parse_table_and_figure_refs` are timed separately.
+
+    bench_subtex.py --files 50 --depth 5 --figures 200 --save-baseline b.json
+    bench_subtex.py --files 50 --depth 5 --figures 200 --baseline b.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import subtex
+
+_LOG = logging.getLogger('subtex.bench')
+
+# Templates of the figure macros subtex parses; `{path}`, `{rpath}` and
+# `{n}` are filled in. Every caption is on its own line and every label
+# on the last line, as `finish_parsing_ref` expects.
+FIGURE_TEMPLATES = [
+    ('graphic', '\\begin{{figure}}\n\\includegraphics[width=\\textwidth]{{{path}}}\n'
+            '\\caption{{Figure {n} of the benchmark.}}\n\\label{{fig:b{n}}}\n'
+            '\\end{{figure}}\n'),
+    ('mfigure', '\\mFigure{{{path}}}{{Figure {n}\nof the benchmark}}\n{{fig:b{n}}}\n'),
+    ('mfigureflex', '\\mFigure{{0.5}}{{{path}}}{{Figure {n}}}\n{{fig:b{n}}}\n'),
+    ('widthfigure', '\\widthFigure{{0.3}}{{{path}}}{{Figure {n}}}\n{{fig:b{n}}}\n'),
+    ('embedfigure', '\\embedFigure{{{path}}}{{Figure {n}}}\n{{fig:b{n}}}\n'),
+    ('embedwidthfigure', '\\embedWidthFigure{{0.5}}{{{path}}}{{Figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ('embedwidthrasterizedfigure', '\\embedWidthFigure{{0.5}}'
+            '{{\\ifuserasterizedplots{{{rpath}}}{{{path}}}}}\n{{Figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ('embedheightfigure', '\\embedHeightFigure{{4}}{{{path}}}{{Figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ('embedheightrasterizedfigure', '\\embedHeightFigure{{4}}'
+            '{{\\ifuserasterizedplots{{{rpath}}}{{{path}}}}}\n{{Figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ('embedappendixfigure', '\\embedAppendixFigure{{{path}}}{{Figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ]
+SI_FIGURE_TEMPLATES = [
+    ('sifigure', '\\siFigure{{{path}}}{{SI figure {n}\nover two lines}}\n'
+            '{{fig:b{n}}}\n'),
+    ('sifigureflex', '\\siFigure{{0.8}}{{{path}}}{{SI figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ('sirasterizedfigure', '\\siFigure{{\\ifuserasterizedplotsinsi{{{rpath}}}'
+            '{{{path}}}}}\n{{SI figure {n}}}\n{{fig:b{n}}}\n'),
+    ('sisidewaysfigure', '\\siSidewaysFigure{{{path}}}{{SI figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ('sieightfigure', '\\siEightFigure{{{path}}}{{SI figure {n}}}\n'
+            '{{fig:b{n}}}\n'),
+    ]
+PARAGRAPH = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit '
+        '\\citep{{ref{0}}}, sed do eiusmod tempor incididunt ut labore.\n')
+TABLE = ('\\begin{{table}}\n\\captionsetup{{name=Table S}}\n'
+        '\\caption{{Table {0} with {{nested}} braces.}}\n\\label{{tab:b{0}}}\n'
+        '\\begin{{tabular}}{{ll}}\na & b \\\\\n\\end{{tabular}}\n\\end{{table}}\n')
+
+
+class ProjectGenerator(object):
+    """
+    Writes a synthetic LaTeX project into `root`.
+
+    The main file `ms.tex` inputs a chain of `depth` nested files and then
+    the remaining of the `files` section files; `figures` figures are
+    spread over the sections and `si_figures` figures (plus `si_tables`
+    tables) make up the supporting information. Every section file has
+    `lines` lines of text. The bib file has `bib_entries` entries.
+    """
+    def __init__(self, root,
+            files = 20,
+            depth = 3,
+            figures = 50,
+            si_figures = 20,
+            si_tables = 10,
+            lines = 500,
+            bib_entries = 2000,
+            figure_size = 4096):
+        self.root = root
+        self.files = max(files, depth, 1)
+        self.depth = depth
+        self.figures = figures
+        self.si_figures = si_figures
+        self.si_tables = si_tables
+        self.lines = lines
+        self.bib_entries = bib_entries
+        self.figure_size = figure_size
+        self.figure_index = 0
+
+    def _write(self, name, content):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as stream:
+            stream.write(content)
+        return path
+
+    def _figure(self, templates):
+        self.figure_index += 1
+        n = self.figure_index
+        key, template = templates[n % len(templates)]
+        path = 'figures/fig{0}.pdf'.format(n)
+        rpath = 'figures/fig{0}r.png'.format(n)
+        self._write(path, os.urandom(self.figure_size))
+        if 'rasterized' in key:
+            self._write(rpath, os.urandom(self.figure_size))
+        return template.format(path = path, rpath = rpath, n = n)
+
+    def _section(self, index, figures, child = None):
+        parts = []
+        for i in range(self.lines):
+            parts.append(PARAGRAPH.format(
+                    (index * self.lines + i) % max(self.bib_entries, 1)))
+            if figures and (i % max(1, self.lines // figures) == 0):
+                parts.append(self._figure(FIGURE_TEMPLATES))
+                figures -= 1
+        while figures > 0:
+            parts.append(self._figure(FIGURE_TEMPLATES))
+            figures -= 1
+        if child:
+            parts.append('\\input{{{0}}}\n'.format(child))
+        return ''.join(parts)
+
+    def generate(self):
+        if not os.path.isdir(os.path.join(self.root, 'figures')):
+            os.makedirs(os.path.join(self.root, 'figures'))
+        self._write('bench.cls', '\\NeedsTeXFormat{LaTeX2e}\n'
+                '\\LoadClass{article}\n')
+        self._write('bench.bst', '% bst\n')
+        self._write('refs.bib', ''.join(
+                '@article{{ref{0},\n  title = {{Title {0}}},\n'
+                '  author = {{Author, A.}},\n  year = {{2013}}\n}}\n\n'.format(i)
+                for i in range(self.bib_entries)))
+        names = ['sec{0}.tex'.format(i) for i in range(self.files)]
+        per_file = [self.figures // self.files] * self.files
+        for i in range(self.figures % self.files):
+            per_file[i] += 1
+        for i, name in enumerate(names):
+            child = None
+            if i + 1 < self.depth:
+                child = names[i + 1]
+            self._write(name, self._section(i, per_file[i], child))
+        main = ['\\documentclass[12pt]{bench}\n', '\\begin{document}\n']
+        main.append('\\input{{{0}}}\n'.format(names[0]))
+        for name in names[max(self.depth, 1):]:
+            main.append('\\input{{{0}}}\n'.format(name))
+        main.append('\\bibliographystyle{bench}\n\\bibliography{refs}\n')
+        main.append('% supporting info\n\\section{Supporting information}\n')
+        for i in range(self.si_tables):
+            main.append(TABLE.format(i))
+        for i in range(self.si_figures):
+            main.append(self._figure(SI_FIGURE_TEMPLATES))
+        main.append('\\end{document}\n')
+        return self._write('ms.tex', ''.join(main))
+
+
+def get_file_size(path):
+    with open(path, 'rU') as stream:
+        lines = sum(1 for l in stream)
+    return lines, os.path.getsize(path)
+
+def get_project_size(graph):
+    lines = 0
+    size = 0
+    for path, node in graph.nodes.iteritems():
+        if node.kind != 'tex':
+            continue
+        l, s = get_file_size(path)
+        lines += l
+        size += s
+    return lines, size
+
+def time_call(func, repeat, setup = None):
+    """
+    Return the fastest of `repeat` calls of `func`. If given, `setup` is
+    called (untimed) before each call, and its result passed to `func`.
+    """
+    times = []
+    for i in range(repeat):
+        args = ()
+        if setup:
+            args = (setup(),)
+        t = time.time()
+        func(*args)
+        times.append(time.time() - t)
+    return min(times)
+
+def run_benchmarks(latex_path, work_dir, repeat = 3, cache = False):
+    """
+    Time the bundling steps on the project rooted at `latex_path` and
+    return a dict of benchmark name to seconds (best of `repeat`), the
+    `(lines, bytes)` of LaTeX in the project, and a dict of the `(lines,
+    bytes)` of the benchmarks that only read part of it.
+    """
+    parse_cache = None
+    if cache:
+        parse_cache = subtex.ParseCache(os.path.join(work_dir, 'cache'))
+    results = {}
+    configs = [
+            ('bundle', {}),
+            ('bundle_merge', {'merge': True}),
+            ('bundle_strip_si', {'strip_si': True}),
+            ('bundle_strip_figures', {'strip_figures': True,
+                    'append_figure_names': True}),
+            ('bundle_all', {'merge': True, 'strip_si': True,
+                    'strip_figures': True}),
+            ]
+    for name, kwargs in configs:
+        dest = os.path.join(work_dir, name)
+        def new_bundler():
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            return subtex.SubmissionBundler(latex_path, dest,
+                    parse_cache = parse_cache, **kwargs)
+        results[name] = time_call(lambda b: b.bundle(), repeat,
+                setup = new_bundler)
+
+    graph = subtex.DocumentGraph(latex_path, cache = parse_cache).build()
+    tex_paths = [p for p, n in graph.nodes.iteritems() if n.kind == 'tex']
+    cp_dir = os.path.join(work_dir, 'cp', 'nested')
+    def copy_files():
+        if not os.path.isdir(cp_dir):
+            os.makedirs(cp_dir)
+        g = subtex.DocumentGraph(latex_path, cache = parse_cache)
+        for p in tex_paths:
+            subtex.copy_latex_file(p, cp_dir, over_write = True, graph = g)
+    results['copy_latex_file'] = time_call(copy_files, repeat)
+
+    def parse_refs():
+        b = subtex.SubmissionBundler(latex_path,
+                os.path.join(work_dir, 'refs'), parse_cache = parse_cache)
+        b.graph = subtex.DocumentGraph(latex_path, cache = parse_cache)
+        with open(latex_path, 'rU') as stream:
+            b.parse_table_and_figure_refs(subtex.LineIterator(stream))
+    results['parse_table_and_figure_refs'] = time_call(parse_refs, repeat)
+    sizes = {'parse_table_and_figure_refs': get_file_size(latex_path)}
+    return results, get_project_size(graph), sizes
+
+def format_report(results, lines, size, baseline = None, sizes = None):
+    """
+    Return `results` as a table. Rates are computed over the `lines` and
+    `size` of the project, or over the `(lines, bytes)` in `sizes` for
+    the benchmarks that only read part of it.
+    """
+    rows = ['{0:<30} {1:>10} {2:>12} {3:>8} {4:>9}'.format('benchmark',
+            'seconds', 'lines/s', 'MB/s', 'baseline')]
+    for name in sorted(results):
+        t = results[name]
+        l, s = (sizes or {}).get(name, (lines, size))
+        rate = t and (l / t) or float('inf')
+        mb_rate = t and (s / 1e6 / t) or float('inf')
+        ratio = ''
+        if baseline and (name in baseline):
+            ratio = '{0:.2f}x'.format(baseline[name] / t)
+        rows.append('{0:<30} {1:>10.4f} {2:>12.0f} {3:>8.2f} {4:>9}'.format(
+                name, t, rate, mb_rate, ratio))
+    rows.append('{0} lines, {1:.2f} MB of LaTeX; baseline column is the '
+            'speedup over the baseline'.format(lines, size / 1e6))
+    return '\n'.join(rows)
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage = "\n  %prog [options]",
+            description = "Benchmark subtex.py on a generated project.")
+    parser.add_option("--files", type="int", default=20,
+            help="Number of section files. Default: 20.")
+    parser.add_option("--depth", type="int", default=3,
+            help="Levels of nested \\input. Default: 3.")
+    parser.add_option("--figures", type="int", default=50,
+            help="Number of main-text figures. Default: 50.")
+    parser.add_option("--si-figures", type="int", default=20,
+            help="Number of supporting information figures. Default: 20.")
+    parser.add_option("--si-tables", type="int", default=10,
+            help="Number of supporting information tables. Default: 10.")
+    parser.add_option("--lines", type="int", default=500,
+            help="Lines of text per section file. Default: 500.")
+    parser.add_option("--bib-entries", type="int", default=2000,
+            help="Number of bib entries. Default: 2000.")
+    parser.add_option("--repeat", type="int", default=3,
+            help="Runs per benchmark; the fastest is reported. Default: 3.")
+    parser.add_option("--cache", default=False, action="store_true",
+            help="Use a (warm) parse cache.")
+    parser.add_option("--project", default=None,
+            help=("Benchmark this LaTeX file instead of a generated "
+                  "project."))
+    parser.add_option("--keep", default=False, action="store_true",
+            help="Keep the generated project and outputs.")
+    parser.add_option("--baseline", default=None,
+            help="JSON file of baseline results to compare against.")
+    parser.add_option("--save-baseline", default=None,
+            help="Write the results to this JSON file.")
+    (options, args) = parser.parse_args()
+
+    subtex._LOG.setLevel(logging.ERROR)
+    work_dir = tempfile.mkdtemp(prefix = 'subtex-bench-')
+    try:
+        latex_path = options.project
+        if latex_path is None:
+            project_dir = os.path.join(work_dir, 'project')
+            os.makedirs(project_dir)
+            latex_path = ProjectGenerator(project_dir,
+                    files = options.files,
+                    depth = options.depth,
+                    figures = options.figures,
+                    si_figures = options.si_figures,
+                    si_tables = options.si_tables,
+                    lines = options.lines,
+                    bib_entries = options.bib_entries).generate()
+        results, (lines, size), sizes = run_benchmarks(latex_path,
+                os.path.join(work_dir, 'out'),
+                repeat = options.repeat,
+                cache = options.cache)
+        baseline = None
+        if options.baseline:
+            with open(options.baseline) as stream:
+                baseline = json.load(stream)['results']
+        print format_report(results, lines, size, baseline, sizes)
+        if options.save_baseline:
+            with open(options.save_baseline, 'w') as stream:
+                json.dump({'results': results, 'lines': lines, 'bytes': size,
+                        'options': options.__dict__}, stream, indent = 1,
+                        sort_keys = True)
+    finally:
+        if options.keep:
+            sys.stderr.write('Kept {0}\n'.format(work_dir))
+        else:
+            shutil.rmtree(work_dir)
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,35 @@
 
 import os
 import sys
+import errno
 import logging
 import itertools
 import re
 import shutil
+import hashlib
+import json
+import time
+import select
+import struct
+import mmap
+import cPickle
+import tempfile
+import threading
+import zipfile
+import tarfile
+import multiprocessing
+import BaseHTTPServer
+from collections import OrderedDict, deque
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 logging.basicConfig(level=logging.WARNING)
 _LOG = logging.getLogger("subtex")
+_FICLONE = 0x40049409
 _program_info = {
     'name': os.path.basename(__file__),
     'author': 'Jamie Oaks',
@@ -63,6 +85,1992 @@ class LatexTableRef(LatexReference):
         s += '\\end{table}\n'
         return s
 
+class LatexCommand(object):
+    """
+    A LaTeX command and the arguments that directly follow it.
+
+    `args` is a list of `(delimiter, content)` tuples, where `delimiter` is
+    '{' for mandatory and '[' for optional arguments. `content` is `None`
+    for arguments whose text was not kept.
+    """
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.args = []
+
+    def get_arg(self, index = 0):
+        """
+        Return the content of mandatory argument `index`, or `None`.
+        """
+        args = [c for d, c in self.args if d == '{']
+        if index < len(args):
+            return args[index]
+        return None
+
+class LatexTokenizer(object):
+    """
+    Splits LaTeX text into commands and brace groups in one forward pass.
+
+    Text is given in pieces (e.g., lines) with `feed`; commands whose
+    arguments continue into later pieces are handled. Comments and escaped
+    characters (e.g., ``\\{``, ``\\%``) are skipped. The tokenizer keeps:
+
+    commands
+        The `LatexCommand`s named in `commands`, with their arguments, in
+        the order they are completed.
+    groups
+        The contents of top-level brace groups (if `capture_groups`).
+    environments
+        The names of the environments open at the current position.
+
+    Only the text of open groups that are kept is held in memory, and at
+    most `max_capture` characters of it: beyond that (e.g., a brace that is
+    never closed), the text of the open groups is dropped and their content
+    is `None`.
+    """
+    token_pattern = re.compile(r'\\([A-Za-z@]+\*?|.?)|([{}\[\]%])',
+            re.DOTALL)
+    environment_commands = ('begin', 'end')
+    max_capture = 1 << 20
+
+    def __init__(self, commands = (), capture_groups = False):
+        self.wanted = set(commands)
+        self.capture_groups = capture_groups
+        self.commands = []
+        self.groups = []
+        self.environments = []
+        self.chunks = []
+        self.held = 0
+        self.offset = 0
+        self.stack = []
+        self.capturing = 0
+        self.pending = None
+        self.in_comment = False
+
+    def _keeps(self, command):
+        return (command.name in self.wanted) or (
+                command.name in self.environment_commands)
+
+    def _get_text(self, start, end):
+        pieces = []
+        for chunk_start, chunk in reversed(self.chunks):
+            if chunk_start >= end:
+                continue
+            pieces.append(chunk[max(0, start - chunk_start):
+                    end - chunk_start])
+            if chunk_start <= start:
+                break
+        return ''.join(reversed(pieces))
+
+    def _finish_pending(self):
+        if self.pending is None:
+            return
+        if self.pending.name in self.wanted:
+            self.commands.append(self.pending)
+        self.pending = None
+
+    def _open(self, delimiter, position):
+        command = self.pending
+        self.pending = None
+        top_level = self.capture_groups and (delimiter == '{') and (
+                not self.stack)
+        capture = top_level or ((command is not None) and
+                self._keeps(command))
+        self.stack.append((delimiter, command, position, capture, top_level))
+        if capture:
+            self.capturing += 1
+
+    def _close(self, delimiter, position):
+        while self.stack:
+            d, command, start, capture, top_level = self.stack.pop()
+            content = None
+            if capture:
+                self.capturing -= 1
+                content = self._get_text(start, position)
+            if d != delimiter:
+                continue
+            if top_level:
+                self.groups.append(content)
+            if command is None:
+                return True
+            command.args.append((d, content))
+            if (command.name in self.environment_commands) and (
+                    len(command.args) == 1):
+                self._update_environments(command.name, content)
+            self.pending = command
+            return True
+        return False
+
+    def _update_environments(self, name, environment):
+        environment = environment.strip()
+        if name == 'begin':
+            self.environments.append(environment)
+        elif environment in self.environments:
+            i = len(self.environments) - 1 - self.environments[::-1].index(
+                    environment)
+            del self.environments[i:]
+
+    def _drop_captures(self):
+        _LOG.warning('Not keeping the text of LaTeX arguments longer than '
+                '{0} characters'.format(self.max_capture))
+        self.stack = [(d, command, start, False, False)
+                for d, command, start, capture, top_level in self.stack]
+        self.capturing = 0
+
+    def feed(self, text):
+        base = self.offset
+        self.chunks.append((base, text))
+        self.held += len(text)
+        self.offset += len(text)
+        pos = 0
+        n = len(text)
+        while pos < n:
+            if self.in_comment:
+                i = text.find('\n', pos)
+                if i < 0:
+                    break
+                self.in_comment = False
+                pos = i + 1
+                continue
+            m = self.token_pattern.search(text, pos)
+            end = n
+            if m:
+                end = m.start()
+            if (self.pending is not None) and text[pos: end].strip():
+                self._finish_pending()
+            if m is None:
+                break
+            pos = m.end()
+            name, delimiter = m.groups()
+            if name is not None:
+                self._finish_pending()
+                if name and (name[0].isalpha() or name[0] == '@'):
+                    self.pending = LatexCommand(name, base + m.start())
+            elif delimiter == '%':
+                self.in_comment = True
+            elif delimiter == '{':
+                self._open('{', base + pos)
+            elif delimiter == '}':
+                self._close('{', base + m.start())
+            elif delimiter == '[':
+                if self.pending is not None:
+                    self._open('[', base + pos)
+            elif delimiter == ']':
+                if self.stack and (self.stack[-1][0] == '['):
+                    self._close('[', base + m.start())
+                else:
+                    self._finish_pending()
+        if self.capturing and (self.held > self.max_capture):
+            self._drop_captures()
+        if not self.capturing:
+            self.chunks = []
+            self.held = 0
+
+    def close(self):
+        """
+        Finish the last command; call after the last piece of text.
+        """
+        self._finish_pending()
+        return self
+
+    def get_environment_depth(self, environment):
+        """
+        Return the index of the innermost open `environment` in
+        `environments`, or `None` if it is not open.
+        """
+        for i in range(len(self.environments) - 1, -1, -1):
+            if self.environments[i] == environment:
+                return i
+        return None
+
+    def prune_commands(self, last = ()):
+        """
+        Forget the kept commands that are neither the first of their name
+        nor, for names in `last`, the last one (ignoring commands without
+        arguments).
+        """
+        first = OrderedDict()
+        latest = OrderedDict()
+        for c in self.commands:
+            if c.get_arg() is None:
+                continue
+            if c.name in last:
+                latest[c.name] = c
+            elif not c.name in first:
+                first[c.name] = c
+        self.commands = first.values() + latest.values()
+
+    def get_commands(self, name):
+        """
+        Return the kept commands named `name` in document order.
+        """
+        return sorted((c for c in self.commands if c.name == name),
+                key = lambda c: c.start)
+
+class PatternScanner(object):
+    """
+    Matches lines against a dict of line patterns in a single pass.
+
+    Every pattern in `patterns` must contain a literal LaTeX command (e.g.,
+    ``\\input``). Lines are first checked for a backslash and then run
+    through one compiled alternation of all the command names, so that only
+    the patterns whose command actually occurs in the line are tried. The
+    remaining patterns are tried in the same order as iterating over
+    `patterns`, so results are identical to looping over the dict. If any
+    pattern ignores case, command names are matched regardless of case.
+    """
+    command_pattern = re.compile(r'\\\\([A-Za-z]+)')
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.keys = list(patterns.keys())
+        self.ignore_case = any(p.flags & re.IGNORECASE
+                for p in patterns.values())
+        self.command_keys = {}
+        for k in self.keys:
+            cmd = self.get_command(patterns[k])
+            if self.ignore_case:
+                cmd = cmd.lower()
+            self.command_keys.setdefault(cmd, []).append(k)
+        commands = sorted(self.command_keys.keys(), key=len, reverse=True)
+        self.prefilter = re.compile(r'\\(' + '|'.join(commands) + ')',
+                re.IGNORECASE if self.ignore_case else 0)
+        self.key_order = dict((k, i) for i, k in enumerate(self.keys))
+
+    @classmethod
+    def get_command(cls, pattern):
+        m = cls.command_pattern.search(pattern.pattern)
+        if not m:
+            raise ValueError('Pattern {0!r} does not contain a LaTeX '
+                    'command'.format(pattern.pattern))
+        return m.group(1)
+
+    def candidate_keys(self, line):
+        if not '\\' in line:
+            return []
+        commands = self.prefilter.findall(line)
+        if self.ignore_case:
+            commands = [c.lower() for c in commands]
+        commands = set(commands)
+        if not commands:
+            return []
+        if len(commands) == 1:
+            return self.command_keys[commands.pop()]
+        keys = []
+        for c in commands:
+            keys.extend(self.command_keys[c])
+        return sorted(keys, key=self.key_order.get)
+
+    def iter_matches(self, line, stats = None):
+        """
+        Yield `(key, match)` for every pattern that matches `line`. If
+        `stats` (a `BundleStats`) is given, the attempts are recorded in it.
+        """
+        for k in self.candidate_keys(line):
+            if stats is None:
+                m = self.patterns[k].match(line)
+            else:
+                start = time.time()
+                m = self.patterns[k].match(line)
+                stats.add_match(k, time.time() - start, m is not None)
+            if m:
+                yield k, m
+
+    def match(self, line):
+        """
+        Return `(key, match)` for the first pattern that matches `line`, or
+        `(None, None)` if none do.
+        """
+        for k, m in self.iter_matches(line):
+            return k, m
+        return None, None
+
+class LineIterator(object):
+    """
+    Iterates over the lines of `stream`, keeping track of the index of the
+    last line returned (`line_index`) even when the iteration is shared
+    between several consumers.
+    """
+    def __init__(self, stream, name = None):
+        self.stream = iter(stream)
+        self.name = name or getattr(stream, 'name', '<stream>')
+        self.line_index = -1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.stream.next()
+        self.line_index += 1
+        return line
+
+class CachedMatch(object):
+    """
+    The groups of a regular expression match, in a form that can be pickled
+    and used in place of the match.
+    """
+    def __init__(self, groups, groupdict):
+        self._groups = groups
+        self._groupdict = groupdict
+
+    @classmethod
+    def from_match(cls, match):
+        return cls(match.groups(), match.groupdict())
+
+    def group(self, name):
+        if isinstance(name, int):
+            return self._groups[name - 1]
+        return self._groupdict[name]
+
+    def groups(self):
+        return self._groups
+
+    def groupdict(self):
+        return self._groupdict
+
+class DocumentNode(object):
+    """
+    A file of a LaTeX document.
+
+    For LaTeX files (`kind` 'tex'), the node holds the result of scanning
+    every line: `path_matches` and `header_matches` map line indices to
+    lists of `(pattern key, match)` tuples and `si_lines` holds the indices
+    of supporting-information markers. Once the table and figure captions
+    of the file have been parsed, `si_refs` maps the index of the line the
+    parsing started at to the list of what was found, in order: `('input',
+    path)` or `(kind, caption setup, caption, label)` tuples, where kind is
+    'table' or 'figure'. `cite_keys` holds the keys of every citation
+    (`\\cite`, `\\citep`, `\\nocite`, etc.) outside comments,
+    `graphics_paths` maps line indices to the directories of the
+    `\\graphicspath` declared there, and `include_matches` maps line indices
+    to the `(pattern key, match)` tuples of `\\include`, `\\subfile`,
+    `\\import` and `\\subimport`. `digest` is the SHA-1 hex digest of the
+    text that was scanned.
+    """
+    def __init__(self, path, kind = 'tex'):
+        self.path = path
+        self.kind = kind
+        self.mtime = None
+        self.size = None
+        self.digest = None
+        self.path_matches = {}
+        self.header_matches = {}
+        self.si_lines = set()
+        self.si_refs = {}
+        self.cite_keys = set()
+        self.graphics_paths = {}
+        self.include_matches = {}
+
+    def is_current(self, st):
+        return (self.mtime == st.st_mtime) and (self.size == st.st_size)
+
+    def get_path_matches(self, line_index, line):
+        """
+        Return the `(pattern key, match)` tuples of line `line_index`,
+        checked against `line`, the text of the line as read now. If they
+        do not match it (e.g., the file changed after it was scanned), the
+        line is matched again.
+        """
+        matches = self.path_matches.get(line_index, ())
+        for k, m in matches:
+            fresh = SubmissionBundler.path_patterns[k].match(line)
+            if (fresh is None) or (fresh.groups() != tuple(m.groups())):
+                _LOG.warning('{0!r} changed since it was scanned; matching '
+                        'line {1} again'.format(self.path, line_index + 1))
+                return [(k, CachedMatch.from_match(m)) for k, m in
+                        SubmissionBundler.path_scanner.iter_matches(line)]
+        return matches
+
+    def get_state(self):
+        """
+        Return the scan results of the node as built-in types only.
+        """
+        def plain(matches):
+            return dict((i, [(k, m._groups, m._groupdict) for k, m in l])
+                    for i, l in matches.iteritems())
+        return (self.kind, self.mtime, self.size, plain(self.path_matches),
+                plain(self.header_matches), self.si_lines, self.si_refs,
+                self.cite_keys, self.graphics_paths,
+                plain(self.include_matches), self.digest)
+
+    @classmethod
+    def from_state(cls, path, state):
+        def matches(plain):
+            return dict((i, [(k, CachedMatch(g, d)) for k, g, d in l])
+                    for i, l in plain.iteritems())
+        (kind, mtime, size, path_matches, header_matches, si_lines,
+                si_refs, cite_keys, graphics_paths, include_matches,
+                digest) = state
+        node = cls(path, kind = kind)
+        node.mtime = mtime
+        node.size = size
+        node.path_matches = matches(path_matches)
+        node.header_matches = matches(header_matches)
+        node.si_lines = si_lines
+        node.si_refs = si_refs
+        node.cite_keys = cite_keys
+        node.graphics_paths = graphics_paths
+        node.include_matches = matches(include_matches)
+        node.digest = digest
+        return node
+
+class ParseCache(object):
+    """
+    Persistent cache of scanned LaTeX files (`DocumentNode`s), keyed by
+    path and checked against file mtime and size and the digest of the
+    text, so that an edit that keeps both the size and the mtime (within
+    its resolution) is not missed.
+
+    The cache is stored as a single pickle of built-in types in `cache_dir`
+    and is shared by all documents. It is invalidated as a whole when the
+    line patterns change. At most `max_entries` nodes are kept, the least
+    recently used being dropped first. The content digests of asset files
+    are kept in the same way (`get_digest`), as are the indexes of BibTeX
+    files (`get_bib_index`). A `read_only` cache is never saved, so that
+    several processes can use it at once.
+    """
+    file_name = 'parse-cache.pickle'
+    format_version = 9
+
+    def __init__(self, cache_dir = None, max_entries = 20000,
+            read_only = False):
+        if cache_dir is None:
+            cache_dir = self.get_default_dir()
+        self.cache_dir = expand_path(cache_dir)
+        self.path = os.path.join(self.cache_dir, self.file_name)
+        self.max_entries = max_entries
+        self.read_only = read_only
+        self.signature = self.get_signature()
+        self.states = OrderedDict()
+        self.digests = OrderedDict()
+        self.bib_indexes = OrderedDict()
+        self.dirty = False
+        self._load()
+
+    @classmethod
+    def get_default_dir(cls):
+        d = os.environ.get('SUBTEX_CACHE_DIR', None)
+        if d:
+            return d
+        return os.path.join(os.environ.get('XDG_CACHE_HOME',
+                os.path.join('~', '.cache')), 'subtex')
+
+    @classmethod
+    def get_signature(cls):
+        h = hashlib.sha1('{0} {1}'.format(_program_info['version'],
+                cls.format_version))
+        for patterns in (SubmissionBundler.path_patterns,
+                SubmissionBundler.header_patterns,
+                SubmissionBundler.include_patterns):
+            for k in sorted(patterns):
+                h.update(k)
+                h.update(patterns[k].pattern)
+        h.update(SubmissionBundler.si_pattern.pattern)
+        h.update(SubmissionBundler.cite_pattern.pattern)
+        h.update(SubmissionBundler.graphics_path_pattern.pattern)
+        return h.hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as stream:
+                data = cPickle.load(stream)
+        except Exception, e:
+            _LOG.warning('Could not read parse cache {0!r}: {1}'.format(
+                    self.path, e))
+            return
+        if data[0] == self.signature:
+            self.states = OrderedDict(data[1])
+            self.digests = OrderedDict(data[2])
+            self.bib_indexes = OrderedDict(data[3])
+            for entries in (self.states, self.digests, self.bib_indexes):
+                while len(entries) > self.max_entries:
+                    entries.popitem(last = False)
+
+    def _get_entry(self, entries, path):
+        entry = entries.pop(path, None)
+        if not entry is None:
+            entries[path] = entry
+        return entry
+
+    def _put_entry(self, entries, path, entry):
+        entries.pop(path, None)
+        entries[path] = entry
+        while len(entries) > self.max_entries:
+            entries.popitem(last = False)
+        self.dirty = True
+
+    def get(self, path, st, data = None):
+        """
+        Return the node of `path` if it was scanned from the current text
+        of the file (`data`, if already read), and `None` otherwise.
+        """
+        state = self._get_entry(self.states, path)
+        if state is None:
+            return None
+        node = DocumentNode.from_state(path, state)
+        if node.is_current(st) and (node.digest == text_digest(path, data)):
+            return node
+        return None
+
+    def put(self, node):
+        self._put_entry(self.states, node.path, node.get_state())
+
+    def get_digest(self, path, st):
+        d = self._get_entry(self.digests, path)
+        if d and (d[0] == st.st_mtime) and (d[1] == st.st_size):
+            return d[2]
+        return None
+
+    def put_digest(self, path, st, digest):
+        self._put_entry(self.digests, path, (st.st_mtime, st.st_size, digest))
+
+    def get_bib_index(self, path, st):
+        state = self._get_entry(self.bib_indexes, path)
+        if state and (state[0] == st.st_mtime) and (state[1] == st.st_size):
+            return BibIndex(path, state[2])
+        return None
+
+    def put_bib_index(self, path, st, index):
+        self._put_entry(self.bib_indexes, path,
+                (st.st_mtime, st.st_size, index.entries))
+
+    def save(self):
+        if self.read_only or (not self.dirty):
+            return
+        if not os.path.isdir(self.cache_dir):
+            mkdr(self.cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as stream:
+                cPickle.dump((self.signature, self.states, self.digests,
+                                self.bib_indexes),
+                        stream,
+                        cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.path)
+        except EnvironmentError, e:
+            _LOG.warning('Could not write parse cache {0!r}: {1}'.format(
+                    self.path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.dirty = False
+
+class AssetDigests(object):
+    """
+    Content digests (SHA-1) of asset files, cached by path, mtime and size
+    in memory and, if given, in a `ParseCache`. `prefetch` computes the
+    digests of many files with a pool of `workers` threads.
+    """
+    def __init__(self, cache = None, workers = 4):
+        self.cache = cache
+        self.workers = max(1, workers)
+        self.digests = {}
+
+    def _compute(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, None, None
+        digest = None
+        if self.cache:
+            digest = self.cache.get_digest(path, st)
+        if digest is None:
+            try:
+                digest = file_digest(path)
+            except EnvironmentError:
+                return path, None, None
+        return path, st, digest
+
+    def _store(self, path, st, digest):
+        self.digests[path] = digest
+        if self.cache and digest:
+            if self.cache.get_digest(path, st) != digest:
+                self.cache.put_digest(path, st, digest)
+
+    def prefetch(self, paths):
+        paths = [p for p in set(paths) if not p in self.digests]
+        if not paths:
+            return
+        if (self.workers < 2) or (len(paths) < 2):
+            results = [self._compute(p) for p in paths]
+        else:
+            pool = ThreadPool(min(self.workers, len(paths)))
+            try:
+                results = pool.map(self._compute, paths)
+            finally:
+                pool.close()
+                pool.join()
+        for path, st, digest in results:
+            self._store(path, st, digest)
+
+    def get(self, path):
+        """
+        Return the digest of `path`, or `None` if it cannot be read.
+        """
+        if not path in self.digests:
+            self._store(*self._compute(path))
+        return self.digests[path]
+
+class BibIndex(object):
+    """
+    The offsets of the entries of BibTeX file `path`.
+
+    `entries` lists the `(key, start, end)` of every entry in file order;
+    the key is `None` for entries without one (@string, @preamble and
+    @comment). An entry starts with an '@' at the beginning of a line and
+    ends with the delimiter matching the one it opens with (see
+    `find_end`), so text between entries is left out; an entry that is
+    never closed runs up to the next one. Files are read through a memory
+    map.
+    """
+    entry_pattern = re.compile(r'^[ \t]*@[ \t]*(\w+)[ \t]*([{(])[ \t]*([^,\s{}()]*)',
+            re.MULTILINE)
+    delimiter_pattern = re.compile(r'[{}()"]')
+    crossref_pattern = re.compile(
+            r'\bcrossref\s*=\s*[{"]\s*([^}"\s]+)\s*[}"]', re.IGNORECASE)
+    keyless_types = ('string', 'preamble', 'comment')
+
+    def __init__(self, path, entries = None):
+        self.path = path
+        self.entries = entries
+        if entries is None:
+            self.entries = self.scan(path)
+
+    @classmethod
+    def find_end(cls, data, open_pos):
+        """
+        Return the offset just past the delimiter that closes the entry
+        opened by the '{' or '(' at `open_pos` of `data`, or `None` if there
+        is none. Braces nest in between; an entry opened with '(' ends at
+        the first ')' outside braces and quotes.
+        """
+        paren = data[open_pos] == '('
+        depth = 0
+        in_quote = False
+        for m in cls.delimiter_pattern.finditer(data, open_pos + 1):
+            c = m.group()
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                if depth:
+                    depth -= 1
+                elif not paren:
+                    return m.end()
+            elif paren and (not depth):
+                if c == '"':
+                    in_quote = not in_quote
+                elif (c == ')') and (not in_quote):
+                    return m.end()
+        return None
+
+    @classmethod
+    def scan(cls, path):
+        with open(path, 'rb') as stream:
+            if os.fstat(stream.fileno()).st_size == 0:
+                return []
+            data = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            starts = [(m.start(), m.start(2), m.group(1).lower(), m.group(3))
+                    for m in cls.entry_pattern.finditer(data)]
+            entries = []
+            i = 0
+            while i < len(starts):
+                start, open_pos, kind, key = starts[i]
+                end = cls.find_end(data, open_pos)
+                if end is None:
+                    end = len(data)
+                    if i + 1 < len(starts):
+                        end = starts[i + 1][0]
+                if kind in cls.keyless_types:
+                    key = None
+                entries.append((key, start, end))
+                i += 1
+                while (i < len(starts)) and (starts[i][0] < end):
+                    # an '@' inside a field; the entry goes on
+                    i += 1
+            return entries
+        finally:
+            data.close()
+
+    def prune(self, keys):
+        """
+        Return the text of the entries cited by `keys` (compared
+        case-insensitively), the entries they cross-reference and every
+        entry without a key, in file order.
+        """
+        if not self.entries:
+            return ''
+        index = {}
+        for i, (key, start, end) in enumerate(self.entries):
+            if key:
+                index.setdefault(key.lower(), i)
+        missing = sorted(k for k in keys if not k.lower() in index)
+        if missing:
+            _LOG.warning('Citations not found in {0}: {1}'.format(self.path,
+                    ', '.join(missing)))
+        with open(self.path, 'rb') as stream:
+            data = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            keep = set()
+            to_visit = [index[k.lower()] for k in keys if k.lower() in index]
+            while to_visit:
+                i = to_visit.pop()
+                if i in keep:
+                    continue
+                keep.add(i)
+                key, start, end = self.entries[i]
+                m = self.crossref_pattern.search(data[start:end])
+                if m and (m.group(1).lower() in index):
+                    to_visit.append(index[m.group(1).lower()])
+            return ''.join('{0}\n\n'.format(data[start:end])
+                    for i, (key, start, end) in enumerate(self.entries)
+                    if (key is None) or (i in keep))
+        finally:
+            data.close()
+
+class GraphicsResolver(object):
+    """
+    Finds graphics files the way graphicx does.
+
+    A name without a known graphics extension is tried with each of
+    `extensions` in turn (pdfTeX's default order), and for each, relative
+    to `base_dir` and then to each `\\graphicspath` directory. Directory
+    listings are read once and kept, so resolving a figure does not probe
+    the file system for every candidate.
+    """
+    extensions = ('.pdf', '.png', '.jpg', '.mps', '.jpeg', '.jbig2', '.jb2',
+            '.PDF', '.PNG', '.JPG', '.JPEG', '.JBIG2', '.JB2', '.eps')
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.known_extensions = set(e.lower() for e in self.extensions)
+        self.listings = {}
+
+    def list_dir(self, d):
+        if not d in self.listings:
+            try:
+                self.listings[d] = set(os.listdir(d))
+            except OSError:
+                self.listings[d] = set()
+        return self.listings[d]
+
+    def exists(self, path):
+        d, name = os.path.split(path)
+        return name in self.list_dir(d)
+
+    def resolve(self, raw_path, graphics_dirs = ()):
+        """
+        Return the real path of the file that graphics name `raw_path`
+        refers to, or `None` if there is none.
+        """
+        dirs = [self.base_dir] + [os.path.join(self.base_dir, d)
+                for d in graphics_dirs]
+        names = [raw_path]
+        if not os.path.splitext(raw_path)[-1].lower() in self.known_extensions:
+            names = [raw_path + e for e in self.extensions]
+        for name in names:
+            for d in dirs:
+                p = os.path.normpath(os.path.join(d, name))
+                if self.exists(p):
+                    return os.path.realpath(p)
+        return None
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class _PhaseTimer(object):
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add_time(self.phase, time.time() - self.start)
+        return False
+
+def timed(stats, phase):
+    """
+    Return a context manager that adds the time spent in it to `phase` of
+    `stats`, or that does nothing if `stats` is `None`.
+    """
+    if stats is None:
+        return _NULL_TIMER
+    return _PhaseTimer(stats, phase)
+
+class BundleStats(object):
+    """
+    Instrumentation collected while bundling.
+
+    `phases` maps phase names (e.g., 'parse', 'finish_parsing_ref',
+    'copy_files') to `[seconds, calls]`; `files` maps each LaTeX file to the
+    seconds spent in `_bundle` on it, excluding the files it inputs;
+    `patterns` maps each key of `SubmissionBundler.path_patterns` to
+    `[matches, attempts, seconds, cached]`, where the first three cover the
+    files scanned and `cached` counts the matches of the files taken from
+    the parse cache instead; and `counters` holds totals such as lines
+    scanned and bytes copied. Times and counters may be added from
+    several threads.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.files = {}
+        self.patterns = {}
+        self.counters = {}
+        self.file_stack = []
+        self.lock = threading.Lock()
+
+    def add_time(self, phase, seconds, calls = 1):
+        with self.lock:
+            p = self.phases.setdefault(phase, [0.0, 0])
+            p[0] += seconds
+            p[1] += calls
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_match(self, key, seconds, matched):
+        p = self.patterns.setdefault(key, [0, 0, 0.0, 0])
+        if matched:
+            p[0] += 1
+        p[1] += 1
+        p[2] += seconds
+
+    def add_cached_matches(self, node):
+        """
+        Count the path matches of `node`, taken from the parse cache.
+        """
+        with self.lock:
+            for matches in node.path_matches.itervalues():
+                for k, m in matches:
+                    self.patterns.setdefault(k, [0, 0, 0.0, 0])[3] += 1
+
+    def enter_file(self, path):
+        self.file_stack.append([path, time.time(), 0.0])
+
+    def leave_file(self):
+        path, start, child_time = self.file_stack.pop()
+        elapsed = time.time() - start
+        self.files[path] = self.files.get(path, 0.0) + elapsed - child_time
+        if self.file_stack:
+            self.file_stack[-1][2] += elapsed
+        self.add_time('bundle', elapsed - child_time)
+
+    def to_dict(self):
+        return {'phases': dict((k, {'seconds': v[0], 'calls': v[1]})
+                        for k, v in self.phases.iteritems()),
+                'files': dict(self.files),
+                'patterns': dict((k, {'matches': v[0], 'attempts': v[1],
+                        'seconds': v[2], 'cached': v[3]})
+                        for k, v in self.patterns.iteritems()),
+                'counters': dict(self.counters)}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.phases = dict((k, [v['seconds'], v['calls']])
+                for k, v in d['phases'].iteritems())
+        stats.files = dict(d['files'])
+        stats.patterns = dict((k, [v['matches'], v['attempts'],
+                v['seconds'], v.get('cached', 0)])
+                for k, v in d['patterns'].iteritems())
+        stats.counters = dict(d['counters'])
+        return stats
+
+    def format(self):
+        """
+        Return the statistics as a plain-text report.
+        """
+        lines = ['Phases (seconds, calls):']
+        for k, v in sorted(self.phases.iteritems(), key = lambda x: -x[1][0]):
+            lines.append('  {0:<22} {1:>10.4f} {2:>8d}'.format(k, v[0], v[1]))
+        lines.append('Files (seconds in _bundle, excluding inputs):')
+        for k, v in sorted(self.files.iteritems(), key = lambda x: -x[1]):
+            lines.append('  {0:>10.4f}  {1}'.format(v, k))
+        lines.append('Path patterns (scanned: matches, attempts, seconds; '
+                'cached: matches):')
+        for k, v in sorted(self.patterns.iteritems(),
+                key = lambda x: (-x[1][2], -x[1][3])):
+            lines.append('  {0:<28} {1:>8d} {2:>8d} {3:>10.4f} {4:>8d}'.format(
+                    k, v[0], v[1], v[2], v[3]))
+        lines.append('Counters:')
+        for k, v in sorted(self.counters.iteritems()):
+            lines.append('  {0:<22} {1:>12d}'.format(k, v))
+        return '\n'.join(lines) + '\n'
+
+class BundleResult(tuple):
+    """
+    The `(paths copied, paths failed)` returned by `bundle`, with the
+    `BundleStats` of the bundle (or `None`) as `stats`.
+    """
+    def __new__(cls, paths_copied, paths_failed, stats = None):
+        result = tuple.__new__(cls, (paths_copied, paths_failed))
+        result.stats = stats
+        return result
+
+class _TextStat(object):
+    """
+    Stands in for the `os.stat` result of LaTeX text that is not read from
+    a file.
+    """
+    st_mtime = None
+
+    def __init__(self, text):
+        self.st_size = len(text)
+
+class DocumentGraph(object):
+    """
+    The files of a LaTeX document and the references between them.
+
+    Nodes are LaTeX files (scanned once, or taken from `cache`) and the
+    assets they refer to; edges are typed by the key of the pattern that
+    found them (e.g., 'input', 'bib', 'graphic', 'sifigure', 'include').
+    Paths are resolved the way `SubmissionBundler` resolves them: relative
+    to the directory of the root file `latex_path`, or to the directory of
+    the `\\import` the file was reached through (`base_dirs`). `edges` maps
+    the path of each LaTeX node to the `(pattern key, path, line index)` of
+    every file it refers to. If `stats` (a `BundleStats`) is given, scanning
+    is recorded in it.
+
+    With more than one of `workers`, `build` reads the files of each level
+    of the input tree concurrently, and keeps their contents (`contents`)
+    until they are taken with `pop_contents` (or for as long as the graph,
+    if `keep_contents` is set, e.g., for a graph shared by several
+    bundles). Files larger than `max_contents_size` are not kept; they are
+    scanned and bundled straight from disk.
+
+    Files given with `add_text` (e.g., a document read from stdin) are not
+    read from disk, nor kept in `cache`.
+    """
+    max_cite_text = 1 << 16
+    max_contents_size = 1 << 24
+
+    def __init__(self, latex_path, cache = None, stats = None, workers = 1,
+            keep_contents = False):
+        self.latex_path = expand_path(latex_path)
+        self.latex_dir = os.path.dirname(self.latex_path)
+        self.cache = cache
+        self.stats = stats
+        self.workers = max(1, workers)
+        self.keep_contents = keep_contents
+        self.texts = {}
+        self.nodes = {}
+        self.edges = {}
+        self.base_dirs = {}
+        self.contents = {}
+
+    @classmethod
+    def scan_file(cls, path, st = None, stats = None, data = None):
+        """
+        Return a new node of LaTeX file `path`, scanning `data` (the text of
+        the file, read in universal newline mode) if given.
+        """
+        if st is None:
+            st = os.stat(path)
+        node = DocumentNode(path)
+        node.mtime = st.st_mtime
+        node.size = st.st_size
+        path_scanner = SubmissionBundler.path_scanner
+        header_scanner = SubmissionBundler.header_scanner
+        include_scanner = SubmissionBundler.include_scanner
+        si_pattern = SubmissionBundler.si_pattern
+        comment_pattern = SubmissionBundler.comment_pattern
+        graphics_path_pattern = SubmissionBundler.graphics_path_pattern
+        line_index = -1
+        # lines with citations, and the lines their braces continue onto,
+        # up to the end of the statement (or `max_cite_text` characters)
+        cite_lines = []
+        cite_size = 0
+        cite_depth = 0
+        digest = hashlib.sha1()
+        if data is None:
+            stream = open(path, 'rU')
+        else:
+            stream = StringIO(data)
+            digest.update(data)
+        try:
+            for line_index, line in enumerate(stream):
+                if data is None:
+                    digest.update(line)
+                if si_pattern.match(line):
+                    node.si_lines.add(line_index)
+                matches = [(k, CachedMatch.from_match(m)) for k, m in
+                        path_scanner.iter_matches(line, stats)]
+                if matches:
+                    node.path_matches[line_index] = matches
+                matches = [(k, CachedMatch.from_match(m)) for k, m in
+                        header_scanner.iter_matches(line)]
+                if matches:
+                    node.header_matches[line_index] = matches
+                matches = [(k, CachedMatch.from_match(m)) for k, m in
+                        include_scanner.iter_matches(line)]
+                if matches:
+                    node.include_matches[line_index] = matches
+                if 'graphicspath' in line:
+                    m = graphics_path_pattern.match(line)
+                    if m:
+                        node.graphics_paths[line_index] = re.findall(
+                                r'\{([^{}]*)\}', m.group(1))
+                if cite_depth or ('cite' in line):
+                    if '%' in line:
+                        line = comment_pattern.sub('', line)
+                    cite_lines.append(line)
+                    cite_size += len(line)
+                    cite_depth = max(0, cite_depth + line.count('{') -
+                            line.count('}'))
+                    if (not cite_depth) or (cite_size > cls.max_cite_text):
+                        cls._add_cite_keys(node, cite_lines)
+                        cite_lines = []
+                        cite_size = 0
+                        cite_depth = 0
+        finally:
+            stream.close()
+        node.digest = digest.hexdigest()
+        cls._add_cite_keys(node, cite_lines)
+        if stats:
+            stats.count('files_scanned')
+            stats.count('lines_scanned', line_index + 1)
+            stats.count('bytes_scanned', st.st_size)
+        return node
+
+    @classmethod
+    def _add_cite_keys(cls, node, cite_lines):
+        cite_pattern = SubmissionBundler.cite_pattern
+        for m in cite_pattern.finditer(''.join(cite_lines)):
+            node.cite_keys.update(k.strip() for k in m.group(1).split(',')
+                    if k.strip())
+
+    def get_node(self, path):
+        """
+        Return the scanned node of LaTeX file `path`.
+        """
+        path = expand_path(path)
+        if path in self.texts:
+            return self.nodes[path]
+        return self._add_node(path, os.stat(path))
+
+    def add_text(self, path, text):
+        """
+        Add LaTeX file `path` with contents `text` instead of those on disk
+        (if any), and return its node.
+        """
+        path = expand_path(path)
+        self.texts[path] = text
+        self.nodes.pop(path, None)
+        return self._add_node(path, _TextStat(text), text)
+
+    def _add_node(self, path, st, data = None):
+        node = self.nodes.get(path, None)
+        if node and node.is_current(st):
+            return node
+        node = None
+        cache = self.cache
+        if path in self.texts:
+            cache = None
+        if cache:
+            node = cache.get(path, st, data)
+            if node and self.stats:
+                self.stats.count('files_cached')
+                self.stats.add_cached_matches(node)
+        if node is None:
+            node = self.scan_file(path, st, self.stats, data)
+            if cache:
+                cache.put(node)
+        self.nodes[path] = node
+        self.edges[path] = self.get_edges(node)
+        return node
+
+    def pop_contents(self, path):
+        """
+        Return a stream of the contents of LaTeX file `path` read by `build`,
+        or `None` if they were not read (or were already taken).
+        """
+        if path in self.texts:
+            data = self.texts[path]
+        elif self.keep_contents:
+            data = self.contents.get(path, None)
+        else:
+            data = self.contents.pop(path, None)
+        if data is None:
+            return None
+        return StringIO(data)
+
+    @classmethod
+    def is_tex_key(cls, k):
+        return (k == 'input') or (k in SubmissionBundler.include_patterns)
+
+    def get_edges(self, node):
+        edges = []
+        project_dir = os.path.dirname(node.path)
+        base_dir = self.base_dirs.get(node.path, self.latex_dir)
+        for line_index in sorted(node.path_matches):
+            k, m = node.path_matches[line_index][0]
+            p, fixed_ext = SubmissionBundler.get_source_path(k,
+                    m.group('path'), base_dir)
+            edges.append((k, p, line_index))
+            if k == 'input':
+                self.base_dirs.setdefault(p, base_dir)
+            rp = m.groupdict().get('rasterizedpath', None)
+            if rp:
+                edges.append((k, os.path.realpath(
+                        os.path.join(project_dir, rp)), line_index))
+        for line_index in sorted(node.include_matches):
+            if line_index in node.path_matches:
+                continue
+            k, m = node.include_matches[line_index][0]
+            p, child_base_dir = SubmissionBundler.get_include_path(k, m,
+                    base_dir, self.latex_dir)
+            edges.append((k, p, line_index))
+            self.base_dirs.setdefault(p, child_base_dir)
+        return edges
+
+    def build(self):
+        """
+        Scan every LaTeX file reachable from the root through 'input' (and
+        include) edges and add nodes for the files they refer to.
+        """
+        if (self.workers > 1) or self.keep_contents:
+            return self._build_concurrently()
+        to_visit = [self.latex_path]
+        visited = set()
+        while to_visit:
+            path = to_visit.pop()
+            if path in visited:
+                continue
+            visited.add(path)
+            try:
+                node = self.get_node(path)
+            except EnvironmentError, e:
+                _LOG.warning('Could not scan {0!r}: {1}'.format(path, e))
+                continue
+            for k, p, line_index in self.edges[path]:
+                if self.is_tex_key(k):
+                    to_visit.append(p)
+                elif not p in self.nodes:
+                    self.nodes[p] = DocumentNode(p, kind = 'asset')
+        if self.cache:
+            self.cache.save()
+        return self
+
+    def _build_concurrently(self):
+        pool = ThreadPool(self.workers)
+        try:
+            level = [self.latex_path]
+            visited = set(level)
+            while level:
+                next_level = []
+                for path, st, data, error in pool.map(self._read_text,
+                        level):
+                    if error:
+                        _LOG.warning('Could not scan {0!r}: {1}'.format(
+                                path, error))
+                        continue
+                    self._add_node(path, st, data)
+                    if not ((data is None) or (path in self.texts)):
+                        self.contents[path] = data
+                    for k, p, line_index in self.edges[path]:
+                        if self.is_tex_key(k):
+                            if not p in visited:
+                                visited.add(p)
+                                next_level.append(p)
+                        elif not p in self.nodes:
+                            self.nodes[p] = DocumentNode(p, kind = 'asset')
+                level = next_level
+        finally:
+            pool.close()
+            pool.join()
+        if self.cache:
+            self.cache.save()
+        return self
+
+    def _read_text(self, path):
+        if path in self.texts:
+            return path, _TextStat(self.texts[path]), self.texts[path], None
+        return _read_text(path)
+
+    def iter_edges(self, key = None):
+        """
+        Yield `(source path, pattern key, target path, line index)` for
+        every edge, or only those of pattern `key`.
+        """
+        for path, edges in self.edges.iteritems():
+            for edge in edges:
+                if (key is None) or (edge[0] == key):
+                    yield (path,) + edge
+
+class BundleSink(object):
+    """
+    Base class of the places a bundle is written to.
+
+    Every sink keeps an index of its entry names (`names`) so that two
+    different files cannot be given the same name. Subclasses implement
+    `open` (a writable text stream for entry `name`) and `add_file` (copy
+    file `src` to entry `name`).
+    """
+    def __init__(self, path):
+        self.path = expand_path(path)
+        self.names = set()
+
+    def start(self):
+        """
+        Prepare the sink for a bundle.
+        """
+        pass
+
+    def close(self):
+        pass
+
+    def get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def reserve(self, name):
+        """
+        Claim entry `name`; raises if it is already taken.
+        """
+        if name in self.names:
+            raise Exception('Multiple files with name {0}!'.format(
+                    self.get_path(name)))
+        self.names.add(name)
+
+    def release(self, names):
+        """
+        Stop treating `names` as taken (e.g., because they are outputs of a
+        previous bundle that will be replaced).
+        """
+        self.names.difference_update(names)
+
+class DirectorySink(BundleSink):
+    """
+    Writes a bundle as files in directory `path`.
+    """
+    def start(self):
+        if not os.path.exists(self.path):
+            mkdr(self.path)
+        self.names = set(os.listdir(self.path))
+
+    def open(self, name):
+        return open(self.get_path(name), 'w')
+
+    def add_file(self, src, name, strategy = 'copy'):
+        """
+        Transfer `src` to a temporary file next to entry `name` and rename it
+        into place, so that an existing file (e.g., the output of a previous
+        bundle) is only replaced once the transfer succeeded.
+        """
+        dest = self.get_path(name)
+        if (strategy == 'link') and os.path.exists(dest) and (
+                os.path.samefile(src, dest)):
+            return
+        part = dest + '.subtex-part'
+        if os.path.lexists(part):
+            os.remove(part)
+        try:
+            transfer_file(src, part, strategy)
+            os.rename(part, dest)
+        except:
+            if os.path.lexists(part):
+                os.remove(part)
+            raise
+
+class _ArchiveEntryStream(object):
+    """
+    Collects the text of an archive entry and adds it on `close`.
+    """
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.buffer = StringIO()
+        self.write = self.buffer.write
+
+    def close(self):
+        if self.buffer is None:
+            return
+        self.sink.add_content(self.name, self.buffer.getvalue())
+        self.buffer.close()
+        self.buffer = None
+
+class ArchiveSink(BundleSink):
+    """
+    Writes a bundle into an archive file at `path`.
+
+    Files are streamed from their sources straight into the archive; the
+    text of each LaTeX output is held in memory until it is closed. Entries
+    are added one at a time, so the sink can be shared by threads.
+    """
+    def __init__(self, path):
+        BundleSink.__init__(self, path)
+        self.lock = threading.Lock()
+        self.archive = None
+
+    def start(self):
+        d = os.path.dirname(self.path)
+        if not os.path.exists(d):
+            mkdr(d)
+        self.names = set()
+        self.archive = self._open_archive()
+
+    def close(self):
+        if not self.archive is None:
+            self.archive.close()
+            self.archive = None
+
+    def get_path(self, name):
+        return '{0}:{1}'.format(self.path, name)
+
+    def open(self, name):
+        return _ArchiveEntryStream(self, name)
+
+    def add_file(self, src, name, strategy = None):
+        with self.lock:
+            self._add_file(src, name)
+
+    def add_content(self, name, content):
+        with self.lock:
+            self._add_content(name, content)
+
+class ZipSink(ArchiveSink):
+    def _open_archive(self):
+        return zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED,
+                allowZip64 = True)
+
+    def _add_file(self, src, name):
+        self.archive.write(src, name)
+
+    def _add_content(self, name, content):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        self.archive.writestr(info, content)
+
+class TarSink(ArchiveSink):
+    modes = (('.tar', 'w'), ('.tar.gz', 'w:gz'), ('.tgz', 'w:gz'),
+            ('.tar.bz2', 'w:bz2'))
+
+    def __init__(self, path, mode = 'w'):
+        ArchiveSink.__init__(self, path)
+        self.mode = mode
+
+    def _open_archive(self):
+        return tarfile.open(self.path, self.mode)
+
+    def _add_file(self, src, name):
+        self.archive.add(src, arcname = name, recursive = False)
+
+    def _add_content(self, name, content):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = time.time()
+        info.mode = 0644
+        self.archive.addfile(info, StringIO(content))
+
+class _PlanEntryStream(object):
+    """
+    Counts the bytes written to a planned entry and records it on `close`.
+    """
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s)
+
+    def close(self):
+        if self.sink is None:
+            return
+        self.sink.add_entry(self.name, None, 'written', self.size)
+        self.sink = None
+
+class PlanSink(BundleSink):
+    """
+    Writes nothing, but records what a bundle to directory `path` would
+    write: every entry's name, source, kind ('written' for LaTeX and other
+    generated files, 'copied' for copies) and size, the sources that do
+    not exist, and the names that would be given to more than one file
+    (including files already in `path`, which a bundle refuses to replace
+    with copies). `entries` maps each name to the list of its entries, so
+    that colliding entries are all kept.
+    """
+    def __init__(self, path):
+        BundleSink.__init__(self, path)
+        self.entries = OrderedDict()
+        self.existing = set()
+        self.missing = []
+        self.collisions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if os.path.isdir(self.path):
+            self.existing = set(os.listdir(self.path))
+
+    def reserve(self, name):
+        # collisions are recorded by `add_entry` instead of raised
+        self.names.add(name)
+
+    def open(self, name):
+        return _PlanEntryStream(self, name)
+
+    def add_file(self, src, name, strategy = None):
+        try:
+            size = os.stat(src).st_size
+        except OSError:
+            size = None
+        self.add_entry(name, src, 'copied', size)
+
+    def add_entry(self, name, src, kind, size):
+        with self.lock:
+            if size is None:
+                self.missing.append(src)
+            if name in self.entries:
+                self.collisions.setdefault(name,
+                        [self.entries[name][0]['source']]).append(src)
+            elif (kind == 'copied') and (name in self.existing):
+                self.collisions.setdefault(name,
+                        ['(existing file)']).append(src)
+            self.entries.setdefault(name, []).append({'name': name,
+                                                      'source': src,
+                                                      'kind': kind,
+                                                      'size': size})
+
+    def get_plan(self):
+        entries = [e for v in self.entries.itervalues() for e in v]
+        return {'destination': self.path,
+                'entries': entries,
+                'missing': self.missing,
+                'collisions': [{'name': k, 'sources': v}
+                        for k, v in self.collisions.iteritems()],
+                'files': len(entries),
+                'total_bytes': sum(e['size'] or 0 for e in entries)}
+
+class _PipeEntryStream(object):
+    """
+    Writes the text of an entry to a stream that it does not close.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.write = stream.write
+
+    def close(self):
+        self.stream.flush()
+
+class PipeSink(BundleSink):
+    """
+    Writes the LaTeX output `root_name` to `stream` (e.g., stdout) and,
+    instead of copying files, lists them on `asset_stream` (if given) for
+    other tools to fetch: one JSON object per line, with the entry 'name',
+    the 'source' path, the 'kind' ('copied') and 'size', written as soon as
+    the file is known. Other written entries (e.g., a pruned bibliography)
+    are listed with their 'content' and the kind 'written'. Paths of the
+    bundle are relative to `path`.
+    """
+    def __init__(self, stream, root_name, asset_stream = None,
+            path = os.curdir):
+        BundleSink.__init__(self, path)
+        self.stream = stream
+        self.root_name = root_name
+        self.asset_stream = asset_stream
+        self.lock = threading.Lock()
+
+    def open(self, name):
+        if name == self.root_name:
+            return _PipeEntryStream(self.stream)
+        return _ArchiveEntryStream(self, name)
+
+    def add_file(self, src, name, strategy = None):
+        try:
+            size = os.stat(src).st_size
+        except OSError:
+            size = None
+        self._list({'name': name,
+                    'source': src,
+                    'kind': 'copied',
+                    'size': size})
+
+    def add_content(self, name, content):
+        self._list({'name': name,
+                    'source': None,
+                    'kind': 'written',
+                    'size': len(content),
+                    'content': content})
+
+    def _list(self, entry):
+        if self.asset_stream is None:
+            return
+        with self.lock:
+            self.asset_stream.write(json.dumps(entry, sort_keys = True) +
+                    '\n')
+            self.asset_stream.flush()
+
+    def close(self):
+        if not self.asset_stream is None:
+            self.asset_stream.flush()
+
+def open_side_channel(spec):
+    """
+    Return a writable stream for `spec`: 'fd:N' for open file descriptor N
+    (e.g., 'fd:3'), or the path of a file.
+    """
+    if spec.startswith('fd:'):
+        return os.fdopen(int(spec[3:]), 'w')
+    return open(spec, 'w')
+
+def read_text_stream(stream):
+    """
+    Return the text of `stream` with universal newlines, as files are read.
+    """
+    return stream.read().replace('\r\n', '\n').replace('\r', '\n')
+
+def format_plan(plan):
+    """
+    Return `plan` (see `plan_bundle`) as a plain-text report.
+    """
+    lines = ['Plan for {0}:'.format(plan['destination'])]
+    for e in plan['entries']:
+        size = e['size']
+        if size is None:
+            size = 'MISSING'
+        lines.append('  {0:<40} {1:>12}  {2}'.format(e['name'], size,
+                e['source'] or '(written)'))
+    if plan['missing']:
+        lines.append('Missing sources:')
+        lines.extend('  {0}'.format(p) for p in plan['missing'])
+    if plan['collisions']:
+        lines.append('Name collisions:')
+        for c in plan['collisions']:
+            lines.append('  {0}: {1}'.format(c['name'],
+                    ', '.join(str(p or '(written)') for p in c['sources'])))
+    lines.append('{0} files, {1} bytes'.format(plan['files'],
+            plan['total_bytes']))
+    return '\n'.join(lines) + '\n'
+
+def get_sink(path):
+    """
+    Return a zip or tar sink if `path` has an archive extension and a
+    directory sink otherwise.
+    """
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        return ZipSink(path)
+    for ext, mode in TarSink.modes:
+        if lower.endswith(ext):
+            return TarSink(path, mode)
+    return DirectorySink(path)
+
+class AssetCopier(object):
+    """
+    Copies files into a `BundleSink` with a bounded pool of threads.
+
+    Copies are queued with `submit` as soon as they are known and run in the
+    background; `wait` blocks until all queued copies are done and returns
+    the lists of source paths that were and were not copied. How the bytes
+    are moved is set by `strategy` (see `transfer_file`). If `stats` (a
+    `BundleStats`) is given, the time spent copying (summed over threads)
+    and the bytes copied are recorded in it.
+    """
+    strategies = ('copy', 'link', 'reflink', 'sendfile')
+
+    def __init__(self, sink, workers = 4, strategy = 'copy', stats = None):
+        if not strategy in self.strategies:
+            raise ValueError('Unknown copy strategy {0!r}'.format(strategy))
+        self.sink = sink
+        self.workers = max(1, workers)
+        self.strategy = strategy
+        self.stats = stats
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ThreadPool(self.workers)
+        self.pending = []
+        self.paths_copied = []
+        self.paths_failed = []
+
+    def submit(self, src, name, prepare = None, strategy = None):
+        """
+        Queue the copy of `src` to `name`. If given, `prepare` is called
+        (without arguments) just before copying and returns the path of the
+        file to copy in place of `src` (e.g., a resampled image), and
+        `strategy` overrides that of the copier.
+        """
+        self.sink.reserve(name)
+        if not self.pool is None:
+            self.pending.append((src, self.pool.apply_async(self._transfer,
+                    (src, name, prepare, strategy)).get))
+        elif prepare is None:
+            self._finish(src, self._transfer(src, name, strategy = strategy))
+        else:
+            # let whatever `prepare` waits for run alongside the bundle
+            self.pending.append((src, lambda src = src, name = name,
+                    prepare = prepare: self._transfer(src, name, prepare,
+                            strategy)))
+
+    def _transfer(self, src, name, prepare = None, strategy = None):
+        if prepare:
+            src = prepare()
+        strategy = strategy or self.strategy
+        if self.stats is None:
+            return _transfer(self.sink, src, name, strategy)
+        with timed(self.stats, 'copy_files'):
+            error = _transfer(self.sink, src, name, strategy)
+        if not error:
+            self.stats.count('files_copied')
+            try:
+                self.stats.count('bytes_copied', os.path.getsize(src))
+            except OSError:
+                pass
+        return error
+
+    def _finish(self, src, error):
+        if error:
+            _LOG.error('Could not copy file from path {0!r}: {1}'.format(
+                    src, error))
+            self.paths_failed.append(src)
+        else:
+            self.paths_copied.append(src)
+
+    def wait(self):
+        for src, get_result in self.pending:
+            self._finish(src, get_result())
+        self.pending = []
+        return self.paths_copied, self.paths_failed
+
+    def close(self):
+        if not self.pool is None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+class RasterTransformer(object):
+    """
+    Downsamples and recompresses raster figures on a pool of `processes`
+    processes (see `resample_raster`).
+
+    Results are kept in `cache_dir` (a temporary directory, removed by
+    `close`, if `None`), named by the SHA-1 of the contents of the source
+    and of the settings, so a figure is only processed again when it or the
+    settings change. Sources are hashed by the workers too. `close` prunes
+    the least recently used results until the cache holds at most
+    `max_cache_bytes`. Requires the Python Imaging Library (Pillow).
+    """
+    extensions = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+    def __init__(self, cache_dir = None, max_size = None, dpi = None,
+            quality = 85, processes = None, max_cache_bytes = 500 << 20):
+        if Image is None:
+            raise Exception('Resampling raster figures requires the Python '
+                    'Imaging Library (Pillow)')
+        self.remove_cache_dir = cache_dir is None
+        if cache_dir is None:
+            cache_dir = tempfile.mkdtemp(prefix = 'subtex-rasters-')
+        self.cache_dir = expand_path(cache_dir)
+        self.max_size = max_size
+        self.dpi = dpi
+        self.quality = quality
+        self.max_cache_bytes = max_cache_bytes
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = max(1, processes)
+        self.pool = None
+        self.results = {}
+
+    def __getstate__(self):
+        # a copy sent to a worker process runs its transforms in-process
+        state = dict(self.__dict__)
+        state.update(pool = None, results = {}, processes = 1,
+                remove_cache_dir = False)
+        return state
+
+    def get_settings(self):
+        return {'max_size': self.max_size,
+                'dpi': self.dpi,
+                'quality': self.quality}
+
+    def get_cache_path(self, src):
+        h = hashlib.sha1(file_digest(src))
+        h.update(json.dumps(self.get_settings(), sort_keys = True))
+        return os.path.join(self.cache_dir,
+                h.hexdigest() + os.path.splitext(src)[-1].lower())
+
+    def transform(self, src):
+        """
+        Return the path of the file to use in place of `src`, processing it
+        unless the result is already in the cache.
+        """
+        dest = self.get_cache_path(src)
+        for p, result in ((dest, dest), (dest + '.unchanged', src)):
+            if os.path.exists(p):
+                # the modification time orders the results for `prune`
+                os.utime(p, None)
+                return result
+        return resample_raster(src, dest, self.max_size, self.dpi,
+                self.quality)
+
+    def submit(self, src):
+        """
+        Start processing `src` and return a function that waits for it and
+        returns the path of the file to use in its place, or return `None`
+        if `src` is not a raster image or does not exist.
+        """
+        if not os.path.splitext(src)[-1].lower() in self.extensions:
+            return None
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None
+        # the file is hashed by `transform`; this only tells versions apart
+        key = (src, st.st_mtime, st.st_size)
+        if key in self.results:
+            return self.results[key]
+        if not os.path.isdir(self.cache_dir):
+            mkdr(self.cache_dir)
+        if self.processes < 2:
+            get_path = lambda: self._finish(src, lambda: self.transform(src))
+        else:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+            result = self.pool.apply_async(_transform_raster, ((self, src),))
+            get_path = lambda: self._finish(src, result.get)
+        self.results[key] = get_path
+        return get_path
+
+    def _finish(self, src, get_result):
+        try:
+            return get_result()
+        except Exception, e:
+            _LOG.warning('Could not resample {0!r}; copying it as is: '
+                    '{1}'.format(src, e))
+            return src
+
+    def prune(self):
+        """
+        Remove the least recently used results until the cache holds at most
+        `max_cache_bytes`.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            p = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+        for mtime, size, p in sorted(files):
+            if total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(p)
+            except OSError, e:
+                _LOG.warning('Could not remove {0!r}: {1}'.format(p, e))
+                continue
+            total -= size
+
+    def close(self):
+        if not self.pool is None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.results = {}
+        if self.remove_cache_dir and os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+        elif not self.max_cache_bytes is None:
+            self.prune()
+
+def _transform_raster(task):
+    transformer, src = task
+    return transformer.transform(src)
+
+class BundleManifest(object):
+    """
+    Record of the sources read and outputs written by a bundle.
+
+    The manifest is stored as JSON in the destination directory. When a
+    previous manifest exists and was written with the same options, outputs
+    whose sources have not changed (by mtime and size, or failing that by
+    SHA-1 hash) can be reused instead of being written again. If the figure
+    prefix assigned to any figure differs from the previous bundle, nothing
+    after that point is reused.
+    """
+    file_name = '.subtex-manifest.json'
+    version = 1
+
+    def __init__(self, dest_dir, options):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, self.file_name)
+        self.options = options
+        self.sources = {}
+        self.outputs = {}
+        self.figure_prefixes = {}
+        self.stale = False
+        previous = self._load()
+        self.previous_outputs = previous.get('outputs', {})
+        if previous and (previous.get('options') != options):
+            _LOG.info('Bundle options changed; rebuilding everything')
+            previous = {}
+        self.previous_sources = previous.get('sources', {})
+        self.previous_figure_prefixes = previous.get('figure_prefixes', {})
+        self.stale = not previous
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as stream:
+                m = json.load(stream)
+        except (IOError, ValueError), e:
+            _LOG.warning('Could not read manifest {0!r}: {1}'.format(
+                    self.path, e))
+            return {}
+        if m.get('version') != self.version:
+            return {}
+        return m
+
+    def add_source(self, path):
+        """
+        Record the current state of source file `path` and return it, or
+        `None` if it does not exist.
+        """
+        if path in self.sources:
+            return self.sources[path]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        state = {'mtime': st.st_mtime, 'size': st.st_size, 'hash': None}
+        old = self.previous_sources.get(path, None)
+        if old and (old['mtime'] == state['mtime']) and (
+                old['size'] == state['size']):
+            state['hash'] = old['hash']
+        else:
+            state['hash'] = file_digest(path)
+        self.sources[path] = state
+        return state
+
+    def source_changed(self, path):
+        state = self.add_source(path)
+        old = self.previous_sources.get(path, None)
+        return (state is None) or (old is None) or (
+                old['hash'] != state['hash'])
+
+    def check_figure_prefix(self, path, prefix):
+        self.figure_prefixes[path] = prefix
+        if self.stale:
+            return
+        if (path in self.previous_figure_prefixes) and (
+                self.previous_figure_prefixes[path] != prefix):
+            _LOG.info('Figure prefixes changed; rebuilding remaining '
+                    'outputs')
+            self.stale = True
+
+    def add_output(self, name, source, digest = None):
+        self.outputs[name] = {'source': source, 'hash': digest}
+
+    def forget_sources(self, sources):
+        """
+        Drop the recorded state of `sources` (e.g., files that could not be
+        copied), so that the next bundle writes their outputs again. The
+        outputs themselves are kept: a failed copy leaves the previous one
+        in place.
+        """
+        for src in sources:
+            self.sources.pop(src, None)
+
+    def is_copy_current(self, src, name):
+        """
+        Return True if `name` was copied from `src` by the previous bundle
+        and `src` has not changed since.
+        """
+        if self.stale:
+            return False
+        old = self.previous_outputs.get(name, None)
+        if (not old) or (old['source'] != src):
+            return False
+        if not os.path.exists(os.path.join(self.dest_dir, name)):
+            return False
+        return not self.source_changed(src)
+
+    def is_output_current(self, name, digest):
+        """
+        Return True if `name` was written with contents hashing to `digest`
+        by the previous bundle and is still in place.
+        """
+        old = self.previous_outputs.get(name, None)
+        if (not old) or (old['hash'] != digest):
+            return False
+        return os.path.exists(os.path.join(self.dest_dir, name))
+
+    def remove_stale_outputs(self):
+        for name in self.previous_outputs:
+            if name in self.outputs:
+                continue
+            p = os.path.join(self.dest_dir, name)
+            if os.path.exists(p):
+                _LOG.info('Removing stale output {0}'.format(p))
+                os.remove(p)
+
+    def write_partial(self):
+        """
+        Write the manifest of an unfinished bundle. Everything that may have
+        been written is recorded as an output, and no options are recorded,
+        so the next bundle rebuilds everything without tripping over
+        leftover files.
+        """
+        outputs = dict(self.previous_outputs)
+        outputs.update(self.outputs)
+        self.outputs = outputs
+        self.options = None
+        self.write()
+
+    def write(self):
+        m = {'version': self.version,
+             'options': self.options,
+             'sources': self.sources,
+             'outputs': self.outputs,
+             'figure_prefixes': self.figure_prefixes}
+        with open(self.path, 'w') as stream:
+            json.dump(m, stream, indent = 1, sort_keys = True)
+
+class _CappedTee(object):
+    """
+    Writes to `stream`, keeping a copy of what is written until it is
+    longer than `limit` characters.
+    """
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.pieces = []
+        self.size = 0
+
+    def write(self, text):
+        self.stream.write(text)
+        if self.pieces is None:
+            return
+        self.size += len(text)
+        if self.size > self.limit:
+            self.pieces = None
+        else:
+            self.pieces.append(text)
+
+    def getvalue(self):
+        """
+        Return what was written, or `None` if it was too long to keep.
+        """
+        if self.pieces is None:
+            return None
+        return ''.join(self.pieces)
+
 class SubmissionBundler(object):
     custom_fig_path_patterns =  {
                 'mfigureflex': re.compile(r'[^%]*(?<!newcommand{)\\mFigure\{[0-9.]+\}\{(?P<path>[^}#]*)\}.*'),
@@ -95,14 +2103,26 @@ class SubmissionBundler(object):
                 re.IGNORECASE),
         'input': re.compile(r'[^%]*\\input.*\{([^}]*)\}.*'),}
     header_patterns.update(custom_fig_path_patterns)
-    attribute_patterns = {
-        'caption_setup': re.compile(r'\\captionsetup\s*(\{.*)', re.DOTALL),
-        'caption': re.compile(r'\\caption\s*\[*\s*\]*\s*(\{.*)', re.DOTALL),
-        'label': re.compile(r'\\caption\s*\[*\s*\]*\s*\{.*\\label\s*(\{.*)',
-                re.DOTALL),}
+    path_scanner = PatternScanner(path_patterns)
+    header_scanner = PatternScanner(header_patterns)
+    include_patterns = {
+        'include': re.compile(r'[^%]*\\include\{(?P<path>[^}]*)\}.*'),
+        'subfile': re.compile(r'[^%]*\\subfile\{(?P<path>[^}]*)\}.*'),
+        'import': re.compile(r'[^%]*\\import\*?\{(?P<dir>[^}]*)\}\{(?P<path>[^}]*)\}.*'),
+        'subimport': re.compile(r'[^%]*\\subimport\*?\{(?P<dir>[^}]*)\}\{(?P<path>[^}]*)\}.*'),
+        }
+    include_scanner = PatternScanner(include_patterns)
+    begin_document_pattern = re.compile(r'[^%]*\\begin\s*\{document\}')
+    end_document_pattern = re.compile(r'[^%]*\\end\s*\{document\}')
+    attribute_commands = ('captionsetup', 'caption', 'label')
+    custom_fig_stop_pattern = re.compile(r'.*(?<!ref|\{S\})(?<!\{\})\{fig[a-zA-Z0-9:-_]+\}.*')
+    end_patterns = {}
     si_pattern = re.compile(r'^\s*[%]+\s*supporting\s+info.*$', re.IGNORECASE)
     caption_setup_pattern = re.compile(r'[^%]*(?<!newcommand{)(?<!def)\\captionsetup.*\{[^}#]*\}.*')
-    processed_graphics_paths = {}
+    cite_pattern = re.compile(r'\\[a-zA-Z]*cite[a-zA-Z]*\*?\s*(?:\[[^\]]*\]\s*)*\{([^}]*)\}')
+    comment_pattern = re.compile(r'(?<!\\)%.*')
+    graphics_path_pattern = re.compile(r'[^%]*\\graphicspath\s*\{\s*((?:\{[^{}]*\}\s*)+)\}')
+    max_merged_text = 1 << 20
 
     def __init__(self, latex_path, dest_dir,
             strip_comments = True,
@@ -110,13 +2130,30 @@ class SubmissionBundler(object):
             strip_si = False,
             strip_figures = False,
             exclude_caption_setup = False,
-            merge = False):
+            merge = False,
+            copy_workers = 4,
+            copy_strategy = 'copy',
+            incremental = False,
+            parse_cache = None,
+            sink = None,
+            dedup_assets = False,
+            collect_stats = False,
+            raster_transformer = None,
+            read_workers = 1,
+            prune_bib = False,
+            graph = None,
+            shared_assets = None,
+            latex_text = None):
         self.latex_path = expand_path(latex_path)
         self.latex_dir = os.path.dirname(self.latex_path)
         self.dest_dir = expand_path(dest_dir)
-        if not os.path.exists(self.dest_dir):
-            mkdr(self.dest_dir)
-        self.out_path = os.path.join(self.dest_dir, os.path.basename(latex_path))
+        if sink is None:
+            sink = DirectorySink(self.dest_dir)
+        if incremental and not isinstance(sink, DirectorySink):
+            raise ValueError('Incremental bundling requires a directory')
+        self.sink = sink
+        self.out_name = os.path.basename(latex_path)
+        self.out_path = self.sink.get_path(self.out_name)
         self.strip_comments = strip_comments
         self.append_figure_names = append_figure_names
         self.strip_si = strip_si
@@ -124,17 +2161,63 @@ class SubmissionBundler(object):
         self.exclude_caption_setup = exclude_caption_setup
         self.figure_index = 0
         self.si_started = False
+        self.si_markers = 0
+        self.merged_files = {}
+        self.processed_graphics_paths = {}
+        self.graphics_resolver = None
+        self.graphics_dirs = []
         self.merge = merge
         self.out_stream = None
+        self.copy_workers = copy_workers
+        self.copy_strategy = copy_strategy
+        self.copier = None
+        self.incremental = incremental
+        self.manifest = None
+        self.parse_cache = parse_cache
+        self.graph = None
+        self.dedup_assets = dedup_assets
+        self.digests = None
+        self.content_paths = {}
+        self.asset_names = {}
+        self.sources = set()
+        self.asset_dests = {}
         self.paths_copied = []
         self.paths_failed = []
+        self.collect_stats = collect_stats
+        self.stats = None
+        self.raster_transformer = raster_transformer
+        self.transformed = set()
+        self.read_workers = read_workers
+        self.prune_bib = prune_bib
+        self.shared_graph = graph
+        self.shared_assets = shared_assets
+        self.latex_text = latex_text
 
     def _open_stream(self):
-        self.out_stream = open(self.out_path, 'w')
+        self.out_stream = self.sink.open(self.out_name)
 
     def _close_stream(self):
         if not self.out_stream is None:
             self.out_stream.close()
+            self.out_stream = None
+
+    def reset(self):
+        """
+        Clear the state left by a previous call to `bundle`.
+        """
+        self.figure_index = 0
+        self.si_started = False
+        self.si_markers = 0
+        self.merged_files = {}
+        self.processed_graphics_paths = {}
+        self.graphics_dirs = []
+        self.transformed = set()
+        self.content_paths = {}
+        self.asset_names = {}
+        self.sources = set()
+        self.asset_dests = {}
+        self.paths_copied = []
+        self.paths_failed = []
 
     def get_figure_prefix(self):
         self.figure_index += 1
@@ -152,29 +2235,165 @@ class SubmissionBundler(object):
             return True
         return False
 
+    def get_options(self):
+        return {'latex_path': self.latex_path,
+                'strip_comments': self.strip_comments,
+                'append_figure_names': self.append_figure_names,
+                'strip_si': self.strip_si,
+                'strip_figures': self.strip_figures,
+                'exclude_caption_setup': self.exclude_caption_setup,
+                'merge': self.merge,
+                'raster_settings': (self.raster_transformer and
+                        self.raster_transformer.get_settings()),
+                'prune_bib': self.prune_bib,
+                'version': _program_info['version']}
+
+    @classmethod
+    def get_source_path(cls, k, raw_path, base_dir):
+        """
+        Return the path of the file that `raw_path` (matched by pattern `k`)
+        refers to, and whether a default extension was added to it.
+        """
+        p = os.path.realpath(os.path.join(base_dir, raw_path))
+        ext = {'bib': '.bib', 'bib_style': '.bst',
+                'documentclass': '.cls'}.get(k, None)
+        if ext and (os.path.splitext(raw_path)[-1] != ext):
+            return p + ext, True
+        if (k == 'input') and (not os.path.splitext(raw_path)[-1]) and (
+                not os.path.isfile(p)) and os.path.isfile(p + '.tex'):
+            # as LaTeX does
+            return p + '.tex', True
+        return p, False
+
+    @classmethod
+    def get_include_path(cls, k, m, base_dir, root_dir):
+        """
+        Return the path of the LaTeX file included by match `m` of include
+        pattern `k` in a file whose paths are relative to `base_dir`, and the
+        directory the paths of the included file are relative to. The
+        directories of `\\import` are relative to `root_dir` (that of the
+        root file), those of `\\subimport` to `base_dir`.
+        """
+        if k == 'import':
+            base_dir = os.path.realpath(os.path.join(root_dir, m.group('dir')))
+        elif k == 'subimport':
+            base_dir = os.path.realpath(os.path.join(base_dir, m.group('dir')))
+        raw_path = m.group('path').strip()
+        p = os.path.realpath(os.path.join(base_dir, raw_path))
+        if k == 'include':
+            if os.path.splitext(raw_path)[-1] != '.tex':
+                p += '.tex'
+        elif (not os.path.isfile(p)) and os.path.isfile(p + '.tex'):
+            p += '.tex'
+        return p, base_dir
+
     def bundle(self):
+        """
+        Bundle the document and return a `BundleResult`: the lists of paths
+        copied and not copied, with the `BundleStats` of the bundle as
+        `stats` if `collect_stats` is set.
+        """
         path = self.latex_path
         stream = None
-        if self.merge:
-            self._open_stream()
-        self._bundle(path)
-        self._close_stream()
-        return self.paths_copied, self.paths_failed
+        self.stats = None
+        if self.collect_stats:
+            self.stats = BundleStats()
+        start = time.time()
+        with timed(self.stats, 'parse'):
+            if self.shared_graph is None:
+                self.graph = DocumentGraph(self.latex_path,
+                        cache = self.parse_cache,
+                        stats = self.stats,
+                        workers = self.read_workers)
+                if not self.latex_text is None:
+                    # e.g., read from stdin; `latex_path` need not exist
+                    self.graph.add_text(self.latex_path, self.latex_text)
+                self.graph.build()
+            else:
+                self.graph = self.shared_graph
+        if self.dedup_assets:
+            with timed(self.stats, 'digest_assets'):
+                self.digests = AssetDigests(cache = self.parse_cache,
+                        workers = self.copy_workers)
+                self.digests.prefetch(p for src, k, p, i in
+                        self.graph.iter_edges() if self.is_graphic_key(k))
+        self.graphics_resolver = GraphicsResolver(self.latex_dir)
+        self.sink.start()
+        self.copier = AssetCopier(self.sink,
+                workers = self.copy_workers,
+                strategy = self.copy_strategy,
+                stats = self.stats)
+        if self.incremental:
+            self.manifest = BundleManifest(self.sink.path, self.get_options())
+            self.sink.release(self.manifest.previous_outputs.keys())
+        try:
+            if self.merge:
+                self._open_stream()
+                if self.manifest:
+                    self.manifest.add_output(self.out_name, self.latex_path)
+            self._bundle(path)
+            with timed(self.stats, 'copy_wait'):
+                s, f = self.copier.wait()
+        except:
+            if self.manifest:
+                self.manifest.write_partial()
+            raise
+        finally:
+            self._close_stream()
+            with timed(self.stats, 'close_copier'):
+                self.copier.close()
+            with timed(self.stats, 'close_sink'):
+                self.sink.close()
+        self.paths_copied.extend(s)
+        self.paths_failed.extend(f)
+        if not self.shared_assets is None:
+            self._share_assets(s, f)
+        if self.parse_cache:
+            self.parse_cache.save()
+        if self.manifest:
+            self.manifest.forget_sources(f)
+            self.manifest.remove_stale_outputs()
+            self.manifest.write()
+        if self.stats:
+            self.stats.add_time('total', time.time() - start)
+        return BundleResult(self.paths_copied, self.paths_failed, self.stats)
 
-    def _bundle(self, path):
+    def _bundle(self, path, base_dir = None, body_only = False):
         latex_path = expand_path(path)
-        _LOG.info('Bundling latex file {0} to {1}'.format(latex_path, self.dest_dir))
+        if base_dir is None:
+            base_dir = self.latex_dir
+        _LOG.info('Bundling latex file {0} to {1}'.format(latex_path, self.sink.path))
         out = self.out_stream
         if out is None:
-            out_path = os.path.join(self.dest_dir, os.path.basename(latex_path))
-            out = open(out_path, 'w')
-        latex_stream = open(latex_path, 'rU')
-        latex_iter = iter(latex_stream)
+            out_name = os.path.basename(latex_path)
+            if self.manifest:
+                out = StringIO()
+            else:
+                out = self.sink.open(out_name)
+        self.sources.add(latex_path)
+        if self.manifest:
+            self.manifest.add_source(latex_path)
+        if self.stats:
+            self.stats.enter_file(latex_path)
+        node = self.graph.get_node(latex_path)
+        latex_stream = self.graph.pop_contents(latex_path)
+        if latex_stream is None:
+            latex_stream = open(latex_path, 'rU')
+        latex_iter = LineIterator(latex_stream, name = latex_path)
         project_dir = os.path.dirname(latex_path)
         paths_to_copy = set()
         self.paths_copied.append(latex_path)
-        for line_index, line in enumerate(latex_iter):
-            if self.si_pattern.match(line):
+        in_body = not body_only
+        for line in latex_iter:
+            line_index = latex_iter.line_index
+            if not in_body:
+                # only the document body of a subfile is merged
+                in_body = bool(self.begin_document_pattern.match(line))
+                continue
+            if body_only and self.end_document_pattern.match(line):
+                break
+            if line_index in node.si_lines:
+                self.si_markers += 1
                 self.si_started = True
                 self.figure_index = 0
                 out.write('\\clearpage\n')
@@ -199,155 +2418,475 @@ class SubmissionBundler(object):
             if self.exclude_caption_setup and self.caption_setup_pattern.match(line):
                 continue
             new_line = line
-            for k, v in self.path_patterns.iteritems():
-                m = v.match(line)
-                if m:
-                    raw_path =  m.group('path')
-                    _LOG.info('Matched path \'{0}\' with pattern \'{1}\'.'.format(raw_path, k))
-                    # p = os.path.realpath(os.path.join(project_dir, raw_path))
-                    p = os.path.realpath(os.path.join(self.latex_dir, raw_path))
+            if line_index in node.graphics_paths:
+                self.graphics_dirs = node.graphics_paths[line_index]
+            path_matches = node.get_path_matches(line_index, line)
+            if path_matches:
+                k, m = path_matches[0]
+                raw_path =  m.group('path')
+                _LOG.info('Matched path \'{0}\' with pattern \'{1}\'.'.format(raw_path, k))
+                with timed(self.stats, 'resolve_paths'):
+                    p, fix_ext = self.get_source_path(k, raw_path, base_dir)
                     raw_rasterized_path = m.groupdict().get('rasterizedpath', None)
                     rp = None
                     if raw_rasterized_path:
                         rp = os.path.realpath(os.path.join(project_dir, raw_rasterized_path))
-                    fix_bib_ext = False
-                    fix_bst_ext = False
-                    fix_cls_ext = False
-                    if (k == 'bib') and os.path.splitext(raw_path)[-1] != '.bib':
-                        fix_bib_ext = True
-                        p += '.bib'
-                    elif (k == 'bib_style') and os.path.splitext(raw_path)[-1] != '.bst':
-                        fix_bst_ext = True
-                        p += '.bst'
-                    elif (k == 'documentclass') and os.path.splitext(raw_path)[-1] != '.cls':
-                        fix_cls_ext = True
-                        p += '.cls'
-                    if k == 'input':
-                        self._bundle(p)
-                        file_name = os.path.basename(p)
-                        new_line = new_line.replace(raw_path, file_name)
-                        if self.merge:
-                            new_line = ''
+                    resolved = False
+                    if self.is_graphic_key(k) and (
+                            not self.graphics_resolver.exists(p)):
+                        # e.g., no extension, or relative to \graphicspath
+                        graphics_dirs = self.graphics_dirs
+                        if base_dir != self.latex_dir:
+                            graphics_dirs = [base_dir] + graphics_dirs
+                        resolved_path = self.graphics_resolver.resolve(
+                                raw_path, graphics_dirs)
+                        if resolved_path:
+                            _LOG.info('Resolved graphics {0!r} to '
+                                    '{1!r}'.format(raw_path, resolved_path))
+                            p = resolved_path
+                            resolved = True
+                if k == 'input':
+                    if self.merge:
+                        self._merge_file(p, base_dir)
+                        new_line = ''
                     else:
-                        write_line = True
-                        skip_copy = (p in self.processed_graphics_paths)
-                        skip_rasterized_copy = (rp in self.processed_graphics_paths)
+                        self._bundle(p, base_dir)
                         file_name = os.path.basename(p)
-                        rasterized_file_name = None
+                        new_line = new_line.replace(raw_path, file_name)
+                else:
+                    write_line = True
+                    if self.dedup_assets and self.is_graphic_key(k):
+                        p = self.get_content_path(p)
                         if rp:
-                            rasterized_file_name = os.path.basename(rp)
-                        if self.is_graphic_key(k):
-                            if p in self.processed_graphics_paths:
-                                fig_prefix = self.processed_graphics_paths[p]['new_tex_path_prefix']
-                            elif rp  and (rp in self.processed_graphics_paths):
-                                fig_prefix = self.processed_graphics_paths[rp]['new_tex_path_prefix']
-                            else:
-                                fig_prefix = self.get_figure_prefix()
-                                self.processed_graphics_paths[p] = {
+                            rp = self.get_content_path(rp)
+                    skip_copy = (p in self.processed_graphics_paths)
+                    skip_rasterized_copy = (rp in self.processed_graphics_paths)
+                    file_name = os.path.basename(p)
+                    rasterized_file_name = None
+                    if rp:
+                        rasterized_file_name = os.path.basename(rp)
+                    if self.is_graphic_key(k):
+                        if p in self.processed_graphics_paths:
+                            fig_prefix = self.processed_graphics_paths[p]['new_tex_path_prefix']
+                        elif rp  and (rp in self.processed_graphics_paths):
+                            fig_prefix = self.processed_graphics_paths[rp]['new_tex_path_prefix']
+                        else:
+                            fig_prefix = self.get_figure_prefix()
+                            self.processed_graphics_paths[p] = {
+                                    'new_tex_path_prefix': fig_prefix,
+                                    }
+                            if self.manifest:
+                                self.manifest.check_figure_prefix(p, fig_prefix)
+                            if rp:
+                                self.processed_graphics_paths[rp] = {
                                         'new_tex_path_prefix': fig_prefix,
                                         }
-                                if rp:
-                                    self.processed_graphics_paths[rp] = {
-                                            'new_tex_path_prefix': fig_prefix,
-                                            }
-                            if rp:
-                                rasterized_file_name = '{0}r_{1}'.format(
-                                        fig_prefix,
-                                        rasterized_file_name)
-                            file_name = '{0}{1}'.format(fig_prefix,
-                                    file_name)
-                            if self.strip_figures:
-                                if k != 'graphic':
-                                    ref = self.finish_parsing_ref(latex_iter,
-                                            pattern_key = k,
-                                            pattern_line = line,
-                                            pattern_match = m,
-                                            offset = line_index)
-                                    out.write('{0}\n'.format(str(ref)))
-                                write_line = False
-                        new_tex_path = file_name
-                        new_rasterized_tex_path = rasterized_file_name
-                        if fix_bib_ext or fix_bst_ext or fix_cls_ext:
-                            new_tex_path = os.path.splitext(new_tex_path)[0]
-                        if write_line:
-                            new_line = new_line.replace(raw_path, new_tex_path)
+                        if rp:
+                            rasterized_file_name = '{0}r_{1}'.format(
+                                    fig_prefix,
+                                    rasterized_file_name)
+                        file_name = '{0}{1}'.format(fig_prefix,
+                                file_name)
+                        if self.dedup_assets:
+                            file_name = self.get_unique_name(p, file_name)
                             if rp:
-                                new_line = new_line.replace(
-                                        raw_rasterized_path,
-                                        rasterized_file_name)
-                        else:
-                            new_line = ''
-                        if (k == 'documentclass') and (not os.path.exists(p)):
-                            break
-                        if not skip_copy:
-                            paths_to_copy.add((p, os.path.join(self.dest_dir, file_name)))
-                        if rp and (not skip_rasterized_copy):
-                            paths_to_copy.add((rp, os.path.join(self.dest_dir, rasterized_file_name)))
-                    break
+                                rasterized_file_name = self.get_unique_name(
+                                        rp, rasterized_file_name)
+                        if self.strip_figures:
+                            if k != 'graphic':
+                                ref = self.finish_parsing_ref(latex_iter,
+                                        pattern_key = k,
+                                        pattern_line = line,
+                                        pattern_match = m,
+                                        offset = line_index)
+                                out.write('{0}\n'.format(str(ref)))
+                            write_line = False
+                    new_tex_path = file_name
+                    new_rasterized_tex_path = rasterized_file_name
+                    if fix_ext:
+                        new_tex_path = os.path.splitext(new_tex_path)[0]
+                    if write_line and resolved:
+                        # the name may be a substring of others on the line
+                        # (e.g., labels); only replace the argument
+                        new_line = new_line.replace('{' + raw_path + '}',
+                                '{' + new_tex_path + '}', 1)
+                        if rp:
+                            new_line = new_line.replace(
+                                    raw_rasterized_path,
+                                    rasterized_file_name)
+                    elif write_line:
+                        new_line = new_line.replace(raw_path, new_tex_path)
+                        if rp:
+                            new_line = new_line.replace(
+                                    raw_rasterized_path,
+                                    rasterized_file_name)
+                    else:
+                        new_line = ''
+                    if (k == 'documentclass') and (not os.path.exists(p)):
+                        # class is not local (e.g., article); nothing to copy
+                        skip_copy = True
+                        skip_rasterized_copy = True
+                    if (k == 'bib') and self.prune_bib and (not skip_copy):
+                        skip_copy = self._write_pruned_bib(paths_to_copy, p,
+                                file_name)
+                    if not skip_copy:
+                        self._queue_copy(paths_to_copy, p, file_name)
+                    if rp and (not skip_rasterized_copy):
+                        self._queue_copy(paths_to_copy, rp,
+                                rasterized_file_name,
+                                transform = True)
+            elif self.merge and (line_index in node.include_matches):
+                k, m = node.include_matches[line_index][0]
+                p, child_base_dir = self.get_include_path(k, m, base_dir,
+                        self.latex_dir)
+                _LOG.info('Merging {0!r} included with pattern {1!r}.'.format(
+                        p, k))
+                if k == 'include':
+                    out.write('\\clearpage\n')
+                self._merge_file(p, child_base_dir,
+                        body_only = (k == 'subfile'))
+                if k == 'include':
+                    out.write('\\clearpage\n')
+                new_line = ''
             out.write(new_line)
         if out != self.out_stream:
+            if self.manifest:
+                self._write_output(out_name, latex_path, out.getvalue())
             out.close()
         latex_stream.close()
-        s, f = self.copy_files(paths_to_copy)
-        self.paths_copied.extend(s)
-        self.paths_failed.extend(f)
+        if self.stats:
+            self.stats.count('lines_bundled', latex_iter.line_index + 1)
+            self.stats.leave_file()
+
+    def _merge_file(self, path, base_dir, body_only = False):
+        """
+        Write the bundled lines of LaTeX file `path` to the merged output.
+
+        The lines are written as they are bundled and kept in memory
+        (`merged_files`) so that a file included more than once is only
+        processed once, unless they are longer than `max_merged_text`
+        characters or contain supporting-information markers, which change
+        the state of the bundle.
+        """
+        key = (expand_path(path), base_dir, body_only)
+        text = self.merged_files.get(key, None)
+        if not text is None:
+            _LOG.info('Merging {0!r} from memory.'.format(key[0]))
+            if self.stats:
+                self.stats.count('files_merged_from_memory')
+            self.out_stream.write(text)
+            return
+        out_stream = self.out_stream
+        si_markers = self.si_markers
+        self.out_stream = _CappedTee(out_stream, self.max_merged_text)
+        try:
+            self._bundle(path, base_dir, body_only)
+            text = self.out_stream.getvalue()
+        finally:
+            self.out_stream = out_stream
+        if (not text is None) and (self.si_markers == si_markers):
+            self.merged_files[key] = text
+
+    def get_content_path(self, path):
+        """
+        Return the first path seen in this bundle whose contents are
+        identical to those of `path` (which may be `path` itself).
+        """
+        digest = self.digests.get(path)
+        if digest is None:
+            return path
+        return self.content_paths.setdefault(digest, path)
+
+    def get_unique_name(self, path, name):
+        """
+        Return the output name of asset `path`, which is `name` unless that
+        is already taken by another file, in which case a numbered variant
+        (e.g., 'fig-2.pdf') is used.
+        """
+        if path in self.asset_names:
+            return self.asset_names[path]
+        base, ext = os.path.splitext(name)
+        i = 2
+        taken = set(self.asset_names.itervalues())
+        while (name in taken) or (name in self.sink.names):
+            name = '{0}-{1}{2}'.format(base, i, ext)
+            i += 1
+        if name != base + ext:
+            _LOG.warning('Renaming {0!r} to {1!r} to avoid a name '
+                    'collision'.format(path, name))
+        self.asset_names[path] = name
+        return name
+
+    def _write_output(self, name, latex_path, content):
+        digest = hashlib.sha1(content).hexdigest()
+        self.manifest.add_output(name, latex_path, digest)
+        if self.manifest.is_output_current(name, digest):
+            _LOG.info('{0} is up to date'.format(self.sink.get_path(name)))
+            return
+        out = self.sink.open(name)
+        out.write(content)
+        out.close()
+
+    def get_cited_keys(self):
+        """
+        Return the keys cited by the LaTeX files of the document.
+        """
+        keys = set()
+        for node in self.graph.nodes.itervalues():
+            keys.update(node.cite_keys)
+        return keys
+
+    def get_bib_index(self, path):
+        st = os.stat(path)
+        index = None
+        if self.parse_cache:
+            index = self.parse_cache.get_bib_index(path, st)
+        if index is None:
+            index = BibIndex(path)
+            if self.parse_cache:
+                self.parse_cache.put_bib_index(path, st, index)
+        return index
+
+    def _write_pruned_bib(self, paths_to_copy, src, name):
+        """
+        Write the entries of BibTeX file `src` that the document cites to
+        `name`, and return True, or return False if `src` should be copied
+        whole instead (it cannot be read, or the document uses
+        `\\nocite{*}`).
+        """
+        if (src, name) in paths_to_copy:
+            return True
+        keys = self.get_cited_keys()
+        if '*' in keys:
+            return False
+        try:
+            content = self.get_bib_index(src).prune(keys)
+        except EnvironmentError, e:
+            _LOG.warning('Could not prune {0!r}: {1}'.format(src, e))
+            return False
+        paths_to_copy.add((src, name))
+        self.sources.add(src)
+        self.sink.reserve(name)
+        if self.manifest:
+            self.manifest.add_source(src)
+            self._write_output(name, src, content)
+        else:
+            out = self.sink.open(name)
+            out.write(content)
+            out.close()
+        self.paths_copied.append(src)
+        return True
+
+    def _queue_copy(self, paths_to_copy, src, name, transform = False):
+        if (src, name) in paths_to_copy:
+            return
+        paths_to_copy.add((src, name))
+        self.sources.add(src)
+        self.asset_dests.setdefault(src, set()).add(name)
+        if self.manifest:
+            self.manifest.add_output(name, src)
+            if self.manifest.is_copy_current(src, name):
+                _LOG.info('{0} is up to date'.format(
+                        self.sink.get_path(name)))
+                self.sink.reserve(name)
+                self.paths_copied.append(src)
+                return
+            self.manifest.add_source(src)
+        transform = bool(transform and self.raster_transformer)
+        if self.shared_assets:
+            shared_path = self.shared_assets.get((src, transform), None)
+            if shared_path and os.path.isfile(shared_path):
+                # written by an earlier bundle of the same document
+                if transform:
+                    self.transformed.add(src)
+                self.copier.submit(src, name,
+                        prepare = lambda: shared_path,
+                        strategy = 'link')
+                return
+        prepare = None
+        if transform:
+            self.transformed.add(src)
+            prepare = self.raster_transformer.submit(src)
+        self.copier.submit(src, name, prepare)
+
+    def _share_assets(self, copied, failed):
+        """
+        Record where the assets `copied` were written, for the bundles that
+        share `shared_assets` with this one.
+        """
+        if not isinstance(self.sink, DirectorySink):
+            return
+        failed = set(failed)
+        for src in copied:
+            names = self.asset_dests.get(src, None)
+            if (src in failed) or (not names):
+                continue
+            self.shared_assets.setdefault((src, src in self.transformed),
+                    self.sink.get_path(sorted(names)[0]))
+
+    def recopy(self, sources):
+        """
+        Copy `sources` to the destinations they were copied to by the last
+        call to `bundle`, without bundling again.
+        """
+        copied = []
+        failed = []
+        for src in sources:
+            path = src
+            if src in self.transformed:
+                prepare = self.raster_transformer.submit(src)
+                if prepare:
+                    path = prepare()
+            for name in self.asset_dests.get(src, ()):
+                error = _transfer(self.sink, path, name, self.copy_strategy)
+                if error:
+                    _LOG.error('Could not copy file from path {0!r}: '
+                            '{1}'.format(src, error))
+                    failed.append(src)
+                else:
+                    copied.append(src)
+            if self.manifest:
+                self.manifest.sources.pop(src, None)
+                self.manifest.add_source(src)
+        if self.manifest:
+            self.manifest.write()
+        return copied, failed
 
     @classmethod
-    def copy_files(cls, list_of_tuples):
+    def copy_files(cls, list_of_tuples, workers = 1, strategy = 'copy',
+            stats = None):
+        dest_dirs = {}
+        for src, dest in list_of_tuples:
+            dest_dir, name = os.path.split(dest)
+            dest_dirs.setdefault(dest_dir, []).append((src, name))
         paths_copied = []
         paths_failed = []
-        for paths in list_of_tuples:
-            if os.path.exists(paths[1]):
-                raise Exception('Multiple files with name {0}!'.format(paths[1]))
+        for dest_dir, names in dest_dirs.iteritems():
+            sink = DirectorySink(dest_dir)
+            sink.start()
+            copier = AssetCopier(sink, workers = workers, strategy = strategy,
+                    stats = stats)
             try:
-                shutil.copyfile(paths[0], paths[1])
-            except IOError, e:
-                _LOG.error('Could not copy file from path {0!r}'.format(paths[0]))
-                paths_failed.append(paths[0])
-            else:
-                paths_copied.append(paths[0])
+                for src, name in names:
+                    copier.submit(src, name)
+                s, f = copier.wait()
+            finally:
+                copier.close()
+            paths_copied.extend(s)
+            paths_failed.extend(f)
         return paths_copied, paths_failed
 
 
     def parse_table_and_figure_refs(self, line_iter, offset=0):
-        _LOG.info('Parsing ref targets from {0}...'.format(line_iter.name))
+        """
+        Return the lists of table and figure references in the rest of
+        `line_iter` and the files it inputs.
+
+        What is found in each file is kept in its `DocumentNode` (and so in
+        the parse cache), and files are only read again when they change.
+        """
         tables = []
         figures = []
-        for line_index, line in enumerate(line_iter):
-            for h, h_pattern in self.header_patterns.iteritems():
-                m = h_pattern.match(line)
-                if m:
-                    if h == 'input':
-                        project_dir = os.path.dirname(line_iter.name)
-                        p = os.path.realpath(os.path.join(project_dir,
-                                m.groups()[0]))
-                        t, f = self.parse_table_and_figure_refs(open(p, 'rU'))
-                        tables.extend(t)
-                        figures.extend(f)
-                        continue
-                    ref = self.finish_parsing_ref(line_iter,
-                            pattern_key = h,
-                            pattern_line = line,
-                            pattern_match = m,
-                            offset = line_index + offset)
-                    if isinstance(ref, LatexTableRef):
-                        tables.append(ref)
-                    elif isinstance(ref, LatexFigureRef):
-                        figures.append(ref)
+        node = self.graph.get_node(line_iter.name)
+        start = line_iter.line_index + 1
+        items = node.si_refs.get(start, None)
+        if items is None:
+            items = self._parse_si_refs(line_iter, node)
+            node.si_refs[start] = items
+            # documents given as text (e.g. on stdin) are never cached
+            if self.parse_cache and (not node.path in self.graph.texts):
+                self.parse_cache.put(node)
+        for item in items:
+            if item[0] == 'input':
+                t, f = self._get_si_refs(item[1])
+                tables.extend(t)
+                figures.extend(f)
+                continue
+            kind, caption_setup, caption, label = item
+            ref_class = LatexFigureRef
+            if kind == 'table':
+                ref_class = LatexTableRef
+            ref = ref_class(caption_setup = caption_setup,
+                    caption = caption,
+                    label = label,
+                    exclude_caption_setup = self.exclude_caption_setup)
+            if kind == 'table':
+                tables.append(ref)
+            else:
+                figures.append(ref)
         return tables, figures
+
+    def _get_si_refs(self, path):
+        node = self.graph.get_node(path)
+        if 0 in node.si_refs:
+            return self.parse_table_and_figure_refs(LineIterator((),
+                    name = node.path))
+        stream = self.graph.pop_contents(node.path)
+        if stream is None:
+            stream = open(path, 'rU')
+        try:
+            return self.parse_table_and_figure_refs(LineIterator(stream,
+                    name = node.path))
+        finally:
+            stream.close()
+
+    def _parse_si_refs(self, line_iter, node):
+        _LOG.info('Parsing ref targets from {0}...'.format(line_iter.name))
+        items = []
+        for line in line_iter:
+            line_index = line_iter.line_index
+            for h, m in node.header_matches.get(line_index, ()):
+                if h == 'input':
+                    project_dir = os.path.dirname(line_iter.name)
+                    items.append(('input', os.path.realpath(os.path.join(
+                            project_dir, m.groups()[0]))))
+                    continue
+                ref = self.finish_parsing_ref(line_iter,
+                        pattern_key = h,
+                        pattern_line = line,
+                        pattern_match = m,
+                        offset = line_index)
+                if isinstance(ref, LatexTableRef):
+                    items.append(('table', ref.caption_setup, ref.caption,
+                            ref.label))
+                elif isinstance(ref, LatexFigureRef):
+                    items.append(('figure', ref.caption_setup, ref.caption,
+                            ref.label))
+        return items
     
+    @classmethod
+    def get_end_pattern(cls, environment):
+        if not environment in cls.end_patterns:
+            cls.end_patterns[environment] = re.compile(
+                    r'[^%]*\\end\s*\{\s*' + re.escape(environment) +
+                    r'\s*\}.*$')
+        return cls.end_patterns[environment]
+
     def finish_parsing_ref(self, line_iter, pattern_key, pattern_line,
             pattern_match,
             offset = 0):
+        with timed(self.stats, 'finish_parsing_ref'):
+            return self._finish_parsing_ref(line_iter, pattern_key,
+                    pattern_line, pattern_match, offset)
+
+    def _finish_parsing_ref(self, line_iter, pattern_key, pattern_line,
+            pattern_match,
+            offset = 0):
         assert((pattern_key in self.header_patterns.keys()) and
                 (pattern_key != 'input'))
-        search_str = pattern_line
+        is_custom = self.custom_fig_path_patterns.has_key(pattern_key)
+        tokenizer = LatexTokenizer(commands = self.attribute_commands,
+                capture_groups = is_custom)
+        tokenizer.feed(pattern_line)
         line_index = 0
-        if self.custom_fig_path_patterns.has_key(pattern_key):
-            stop = re.compile(r'.*(?<!ref|\{S\})(?<!\{\})\{fig[a-zA-Z0-9:-_]+\}.*')
+        depth = None
+        if is_custom:
+            stop = self.custom_fig_stop_pattern
         else:
-            stop = re.compile(r'[^%]*\\end\s*\{\s*' + pattern_match.groups()[0] +
-                              r'\s*\}.*$')
+            environment = pattern_match.groups()[0]
+            depth = tokenizer.get_environment_depth(environment)
+            stop = self.get_end_pattern(environment)
+        complete = False
         while True:
             try:
                 next_line = line_iter.next()
@@ -356,16 +2895,27 @@ class SubmissionBundler(object):
                 _LOG.warning('Could not find end of definition for '
                         '{0} at line {1} of {2}... skipping!'.format(
                             pattern_key, line_index+offset+1, line_iter.name))
-                search_str = None
                 break
             if next_line.strip().startswith('%'):
                 continue
-            search_str += next_line
-            if stop.match(next_line):
+            tokenizer.feed(next_line)
+            # keep memory flat in long environments (e.g., huge longtables)
+            if len(tokenizer.commands) > 32:
+                tokenizer.prune_commands(last = ('label',))
+            if len(tokenizer.groups) > 6:
+                # more fields than any custom figure has; it fails anyway
+                del tokenizer.groups[6:]
+            if depth is not None:
+                if len(tokenizer.environments) <= depth:
+                    complete = True
+                    break
+            elif stop.match(next_line):
+                complete = True
                 break
-        if search_str:
-            if self.custom_fig_path_patterns.has_key(pattern_key):
-                fig_info = self.parse_custom_figure(search_str)
+        if complete:
+            tokenizer.close()
+            if is_custom:
+                fig_info = self.get_custom_figure_info(tokenizer.groups)
                 caption_setup = fig_info.get('caption_setup', None)
                 if caption_setup is None:
                     if pattern_key.startswith('si'):
@@ -378,15 +2928,7 @@ class SubmissionBundler(object):
                               'exclude_caption_setup': self.exclude_caption_setup}
                 return LatexFigureRef(**attributes)
             else:
-                attributes = {'caption_setup': None,
-                              'caption': '',
-                              'label': None,
-                              'exclude_caption_setup': self.exclude_caption_setup}
-                for a, a_pattern in self.attribute_patterns.iteritems():
-                    s = a_pattern.search(search_str)
-                    if s:
-                        attributes[a] = get_top_level_contents(
-                                s.groups()[0])
+                attributes = self.get_reference_attributes(tokenizer)
                 if pattern_key == 'table':
                     return LatexTableRef(**attributes)
                 elif pattern_key == 'figure':
@@ -394,9 +2936,34 @@ class SubmissionBundler(object):
         raise Exception('Problem parsing {0} at line {1} of {2}'.format(
                 pattern_key, line_index+offset+1, line_iter.name))
 
+    def get_reference_attributes(self, tokenizer):
+        """
+        Return the caption setup, caption and label of a table or figure
+        environment from the commands collected by `tokenizer`: the first
+        `\\captionsetup`, the first `\\caption` and the last `\\label`
+        after the caption.
+        """
+        attributes = {'caption_setup': None,
+                      'caption': '',
+                      'label': None,
+                      'exclude_caption_setup': self.exclude_caption_setup}
+        for c in tokenizer.get_commands('captionsetup'):
+            if c.get_arg() is not None:
+                attributes['caption_setup'] = c.get_arg()
+                break
+        captions = [c for c in tokenizer.get_commands('caption')
+                if c.get_arg() is not None]
+        if captions:
+            caption = captions[0]
+            attributes['caption'] = caption.get_arg()
+            labels = [c for c in tokenizer.get_commands('label')
+                    if (c.start > caption.start) and (c.get_arg() is not None)]
+            if labels:
+                attributes['label'] = labels[-1].get_arg()
+        return attributes
+
     @classmethod
-    def parse_custom_figure(cls, string):
-        fields = list(top_level_content_iter(string))
+    def get_custom_figure_info(cls, fields):
         if len(fields) == 3:
             return dict(zip(['path', 'caption', 'label'], fields))
         elif len(fields) == 5:
@@ -404,8 +2971,8 @@ class SubmissionBundler(object):
         elif len(fields) == 4:
             return dict(zip(['size', 'path', 'caption', 'label'], fields))
         else:
-            raise Exception('could not parse custom figure string '
-                    '{0!r}'.format(string))
+            raise Exception('could not parse custom figure fields '
+                    '{0!r}'.format(fields))
 
     
 def mkdr(path):
@@ -424,71 +2991,1256 @@ def expand_path(path):
     return os.path.abspath(os.path.realpath(os.path.expanduser(
             os.path.expandvars(path))))
 
+def resample_raster(src, dest, max_size = None, dpi = None, quality = 85):
+    """
+    Write raster image `src` to `dest` in the same format, scaled down so
+    that its longest side is at most `max_size` pixels and its resolution
+    (if recorded in the file) at most `dpi`, and recompressed. Return
+    `dest`, or `src` if that is not smaller; in that case an empty
+    `dest` + '.unchanged' file records the outcome instead.
+    """
+    image = Image.open(src)
+    fmt = image.format
+    width, height = image.size
+    src_dpi = image.info.get('dpi', None)
+    scale = 1.0
+    if dpi and src_dpi and (float(src_dpi[0]) > dpi):
+        scale = dpi / float(src_dpi[0])
+    if max_size and (max(width, height) * scale > max_size):
+        scale = max_size / float(max(width, height))
+    if scale < 1.0:
+        image = image.resize((max(1, int(round(width * scale))),
+                max(1, int(round(height * scale)))), Image.ANTIALIAS)
+    kwargs = {}
+    if src_dpi:
+        kwargs['dpi'] = (src_dpi[0] * scale, src_dpi[1] * scale)
+    if fmt == 'PNG':
+        kwargs['optimize'] = True
+    elif fmt == 'JPEG':
+        kwargs.update(quality = quality, optimize = True)
+    elif fmt == 'TIFF':
+        kwargs['compression'] = 'tiff_deflate'
+    fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(dest))
+    try:
+        with os.fdopen(fd, 'wb') as stream:
+            image.save(stream, fmt, **kwargs)
+        if (scale >= 1.0) and (os.path.getsize(tmp_path) >=
+                os.path.getsize(src)):
+            open(dest + '.unchanged', 'w').close()
+            return src
+        os.rename(tmp_path, dest)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dest
+
+def _read_text(path):
+    try:
+        st = os.stat(path)
+        if st.st_size > DocumentGraph.max_contents_size:
+            return path, st, None, None
+        with open(path, 'rU') as stream:
+            return path, st, stream.read(), None
+    except EnvironmentError, e:
+        return path, None, None, e
+
+def file_digest(path, block_size = 1 << 20):
+    """
+    Return the SHA-1 hex digest of the contents of file `path`.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def text_digest(path, data = None):
+    """
+    Return the SHA-1 hex digest of `data`, or if it is `None` of the text of
+    file `path` read in universal newline mode.
+    """
+    h = hashlib.sha1()
+    if data is None:
+        with open(path, 'rU') as stream:
+            for line in stream:
+                h.update(line)
+    else:
+        h.update(data)
+    return h.hexdigest()
+
+def transfer_file(src, dest, strategy = 'copy'):
+    """
+    Copy the contents of file `src` to `dest` using `strategy`:
+
+    copy
+        Plain `shutil.copyfile`.
+    link
+        Hard link `dest` to `src`; falls back to copying if the paths are on
+        different file systems or linking is not permitted.
+    reflink
+        Copy-on-write clone (Linux FICLONE); falls back to copying if the
+        file system does not support it.
+    sendfile
+        Copy in the kernel with `os.sendfile` where available; falls back to
+        copying otherwise.
+    """
+    if strategy == 'link':
+        try:
+            os.link(src, dest)
+            return
+        except OSError, e:
+            if not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif strategy == 'reflink':
+        import fcntl
+        with open(src, 'rb') as in_stream:
+            with open(dest, 'wb') as out_stream:
+                try:
+                    fcntl.ioctl(out_stream.fileno(), _FICLONE,
+                            in_stream.fileno())
+                    return
+                except IOError, e:
+                    pass
+    elif (strategy == 'sendfile') and hasattr(os, 'sendfile'):
+        with open(src, 'rb') as in_stream:
+            with open(dest, 'wb') as out_stream:
+                size = os.fstat(in_stream.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(out_stream.fileno(),
+                            in_stream.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+        return
+    shutil.copyfile(src, dest)
+
+def _transfer(sink, src, name, strategy):
+    try:
+        sink.add_file(src, name, strategy)
+    except EnvironmentError, e:
+        return str(e)
+    return None
+
 def copy_latex_file(latex_path, dest_path, over_write = False,
-        strip_comments = False):
+        strip_comments = False,
+        graph = None,
+        relocate = None,
+        latex_text = None,
+        out = None,
+        base_dir = None,
+        dest_base_dir = None):
+    """
+    Copy LaTeX file `latex_path` to `dest_path`, rewriting the relative
+    paths it refers to so that they point to the same files from the new
+    location. Paths are relative to `base_dir` (by default, the directory
+    of `latex_path`; e.g., that of the root document for an input file) and
+    are rewritten relative to `dest_base_dir` (by default, the directory of
+    `dest_path`). Rasterized figure paths are relative to the directory of
+    the file, as when bundling.
+
+    If `relocate` is given, `relocate(pattern key, path)` returns the path
+    to point to instead (e.g., that of a copy of the file), or `None` to
+    leave the path as it is. If `latex_text` is given, it is used as the
+    contents of `latex_path` (which need not exist), and if `out` is given,
+    the copy is written to that stream (e.g., stdout) as if it were at
+    `dest_path`.
+    """
     latex_path = expand_path(latex_path)
     dest_path = expand_path(dest_path)
     if os.path.isdir(dest_path):
         dest_path = os.path.join(dest_path, os.path.basename(latex_path))
-    if os.path.exists(dest_path) and (not over_write):
+    if (out is None) and os.path.exists(dest_path) and (not over_write):
         raise Exception('Destination path {0!r} already exists'.format(
                 dest_path))
-    path_patterns = SubmissionBundler.path_patterns
-    out = open(dest_path, 'w')
-    latex_stream = open(latex_path, 'rU')
+    if graph is None:
+        graph = DocumentGraph(latex_path)
+    if latex_text is None:
+        node = graph.get_node(latex_path)
+        latex_stream = open(latex_path, 'rU')
+    else:
+        node = graph.add_text(latex_path, latex_text)
+        latex_stream = StringIO(latex_text)
+    close_out = out is None
+    if close_out:
+        out = open(dest_path, 'w')
     latex_iter = iter(latex_stream)
     project_dir = os.path.dirname(latex_path)
     dest_dir = os.path.dirname(dest_path)
+    if base_dir is None:
+        base_dir = project_dir
+    if dest_base_dir is None:
+        dest_base_dir = dest_dir
     for line_index, line in enumerate(latex_iter):
         if strip_comments and line.strip().startswith('%'):
             continue
         new_line = line
-        for k, v in path_patterns.iteritems():
-            m = v.match(line)
-            if m:
-                raw_path =  m.group('path')
-                p = os.path.realpath(os.path.join(project_dir, raw_path))
-                new_path = os.path.relpath(p, dest_dir)
+        for k, m in node.get_path_matches(line_index, line):
+            paths = [(m.group('path'), base_dir, dest_base_dir)]
+            raw_rasterized_path = m.groupdict().get('rasterizedpath', None)
+            if raw_rasterized_path:
+                paths.append((raw_rasterized_path, project_dir, dest_dir))
+            for raw_path, src_dir, new_dir in paths:
+                p = os.path.realpath(os.path.join(src_dir, raw_path))
+                if relocate:
+                    p = relocate(k, p)
+                    if p is None:
+                        continue
+                new_path = os.path.relpath(p, new_dir)
                 new_line = new_line.replace(raw_path, new_path)
         out.write(new_line)
-    out.close()
+    if close_out:
+        out.close()
+    else:
+        out.flush()
     latex_stream.close()
 
 def sublist(l, size=10):
     return (l[i: i + size] for i in range(0, len(l), size))
 
-def get_top_level_contents(string, start='{', end='}'):
-    content_iter = top_level_content_iter(string = string,
-            start = start,
-            end = end)
+class PollingBackend(object):
+    """
+    Detects changes to files by comparing their mtime and size every
+    `interval` seconds.
+    """
+    def __init__(self, interval = 1.0):
+        self.interval = interval
+        self.states = {}
+
+    @classmethod
+    def get_state(cls, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def set_paths(self, paths):
+        self.states = dict((p, self.states.get(p, self.get_state(p)))
+                for p in paths)
+
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            changed = set()
+            for p, state in self.states.iteritems():
+                new_state = self.get_state(p)
+                if new_state != state:
+                    self.states[p] = new_state
+                    changed.add(p)
+            if changed:
+                return changed
+
+    def close(self):
+        pass
+
+class InotifyBackend(object):
+    """
+    Detects changes to files with Linux inotify (via ctypes).
+
+    The parent directory of every file is watched, rather than the file
+    itself, so that files replaced by editors on save and files that do not
+    exist yet are noticed.
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, settle_time = 0.1):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                use_errno = True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.settle_time = settle_time
+        self.dir_watches = {}
+        self.watch_dirs = {}
+        self.paths = set()
+
+    def set_paths(self, paths):
+        self.paths = set(paths)
+        dirs = set(os.path.dirname(p) for p in self.paths)
+        for d in set(self.dir_watches) - dirs:
+            wd = self.dir_watches.pop(d)
+            self.watch_dirs.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+        for d in dirs - set(self.dir_watches):
+            if not os.path.isdir(d):
+                _LOG.warning('Cannot watch missing directory {0!r}'.format(d))
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, d, self.mask)
+            if wd < 0:
+                _LOG.warning('Could not watch directory {0!r}'.format(d))
+                continue
+            self.dir_watches[d] = wd
+            self.watch_dirs[wd] = d
+
+    def _read_events(self):
+        changed = set()
+        buf = os.read(self.fd, 65536)
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = self.event_header.unpack_from(buf, i)
+            i += self.event_header.size
+            name = buf[i: i + length].rstrip('\0')
+            i += length
+            d = self.watch_dirs.get(wd, None)
+            if (d is None) or (not name):
+                continue
+            p = os.path.join(d, name)
+            if p in self.paths:
+                changed.add(p)
+        return changed
+
+    def wait(self):
+        while True:
+            select.select([self.fd], [], [])
+            changed = self._read_events()
+            # collect the burst of events caused by a single save
+            while select.select([self.fd], [], [], self.settle_time)[0]:
+                changed.update(self._read_events())
+            if changed:
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class BundleWatcher(object):
+    """
+    Keeps the destination of `bundler` in sync with its sources.
+
+    The document is bundled once (incrementally), then every file found by
+    the bundle is watched. Changes to figures and other copied files are
+    recopied directly; changes to LaTeX files re-bundle the document, which
+    rewrites only the outputs that changed. Files newly referenced by the
+    document are watched after the bundle that finds them.
+    """
+    def __init__(self, bundler, interval = 1.0, backend = None):
+        self.bundler = bundler
+        self.bundler.incremental = True
+        if backend is None:
+            backend = self.get_backend(interval)
+        self.backend = backend
+
+    @classmethod
+    def get_backend(cls, interval = 1.0):
+        if sys.platform.startswith('linux'):
+            try:
+                return InotifyBackend()
+            except (OSError, AttributeError), e:
+                _LOG.info('inotify unavailable ({0}); polling for '
+                        'changes'.format(e))
+        return PollingBackend(interval = interval)
+
+    def rebundle(self):
+        self.bundler.reset()
+        try:
+            paths_copied, paths_failed = self.bundler.bundle()
+        except Exception, e:
+            _LOG.error('Bundling failed: {0}'.format(e))
+            paths_failed = []
+        for p in paths_failed:
+            _LOG.warning('Could not copy {0!r}'.format(p))
+        self.backend.set_paths(self.get_watched_paths())
+
+    def get_watched_paths(self):
+        """
+        Return the sources of the last bundle, with the `.tex` file LaTeX
+        would read for each missing source without an extension (e.g., an
+        `\\input{file}` that is yet to be written).
+        """
+        paths = set(self.bundler.sources)
+        for p in self.bundler.sources:
+            if (not os.path.splitext(p)[-1]) and (not os.path.exists(p)):
+                paths.add(p + '.tex')
+        return paths
+
+    def update(self, changed):
+        assets = set(p for p in changed if p in self.bundler.asset_dests)
+        if changed - assets:
+            _LOG.warning('Change in {0}; re-bundling'.format(
+                    ', '.join(sorted(changed - assets))))
+            self.rebundle()
+            return
+        _LOG.warning('Change in {0}; recopying'.format(
+                ', '.join(sorted(assets))))
+        self.bundler.recopy([p for p in assets if os.path.exists(p)])
+
+    def run(self):
+        self.rebundle()
+        _LOG.warning('Watching {0} files for changes; press Ctrl-C to '
+                'stop'.format(len(self.get_watched_paths())))
+        try:
+            while True:
+                self.update(self.backend.wait())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.backend.close()
+
+_batch_cache = None
+
+class _WorkerPool(object):
+    """
+    A pool of `processes` worker processes (none if fewer than two, in which
+    case `map` runs the tasks in this process) that share `parse_cache`:
+    while the pool is open, the cache is read-only and is `_batch_cache`,
+    which the workers forked from this process inherit.
+    """
+    def __init__(self, processes, parse_cache = None):
+        self.processes = processes
+        self.parse_cache = parse_cache
+        self.read_only = None
+        self.pool = None
+
+    def __enter__(self):
+        global _batch_cache
+        if self.parse_cache:
+            self.read_only = self.parse_cache.read_only
+            self.parse_cache.read_only = True
+        _batch_cache = self.parse_cache
+        if self.processes > 1:
+            try:
+                self.pool = multiprocessing.Pool(self.processes)
+            except:
+                self._restore()
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.pool is None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self._restore()
+        return False
+
+    def _restore(self):
+        global _batch_cache
+        _batch_cache = None
+        if self.parse_cache:
+            self.parse_cache.read_only = self.read_only
+
+    def map(self, func, tasks, chunksize = None):
+        if self.pool is None:
+            return [func(t) for t in tasks]
+        return self.pool.map(func, tasks, chunksize)
+
+def read_batch_file(path):
+    """
+    Return the `(latex path, destination directory)` of every document
+    listed in batch file `path`.
+
+    Each non-empty line that does not start with '#' holds the path of a
+    main LaTeX file, optionally followed by its destination directory
+    (default: a 'submit' directory next to the LaTeX file). Relative paths
+    are relative to the directory of the batch file.
+    """
+    path = expand_path(path)
+    base_dir = os.path.dirname(path)
+    jobs = []
+    with open(path, 'rU') as stream:
+        for line in stream:
+            line = line.strip()
+            if (not line) or line.startswith('#'):
+                continue
+            fields = line.split(None, 1)
+            latex_path = expand_path(os.path.join(base_dir, fields[0]))
+            dest_dir = None
+            if len(fields) > 1:
+                dest_dir = expand_path(os.path.join(base_dir, fields[1]))
+            jobs.append((latex_path, dest_dir))
+    return jobs
+
+def plan_bundle(latex_path, dest_dir, **kwargs):
+    """
+    Return the plan of bundling `latex_path` into `dest_dir` with a
+    `SubmissionBundler` created with `kwargs`, without writing anything:
+    a dictionary of the 'destination', the 'entries' (each with a 'name',
+    'source', 'kind' and 'size'), 'missing' sources, name 'collisions',
+    and the number of 'files' and 'total_bytes'.
+
+    The document is matched and resolved as by a bundle (figure prefixes
+    included), but sources are only stat'ed; entries with the same name
+    are all listed, and also reported as 'collisions'. With `dedup_assets`,
+    figures are still read and hashed, since the names they get depend on
+    their contents.
+    """
+    kwargs.update(sink = PlanSink(dest_dir),
+            copy_workers = 1,
+            incremental = False,
+            raster_transformer = None)
+    bundler = SubmissionBundler(latex_path, dest_dir, **kwargs)
+    bundler.bundle()
+    return bundler.sink.get_plan()
+
+def run_bundle(latex_path, dest_dir, **kwargs):
+    """
+    Bundle `latex_path` into `dest_dir` with a new `SubmissionBundler`
+    (created with `kwargs`) and return a dictionary of the 'latex_path',
+    'dest_dir', the lists of paths 'copied' and 'failed', the 'error' that
+    stopped the bundle (or `None`) and its 'stats' (or `None`).
+    """
+    result = {'latex_path': latex_path,
+              'dest_dir': dest_dir,
+              'copied': [],
+              'failed': [],
+              'error': None,
+              'stats': None}
+    try:
+        bundler = SubmissionBundler(latex_path, dest_dir, **kwargs)
+        r = bundler.bundle()
+    except Exception, e:
+        _LOG.error('Could not bundle {0!r}: {1}'.format(latex_path, e))
+        result['error'] = str(e)
+        return result
+    result['copied'], result['failed'] = r
+    if r.stats:
+        result['stats'] = r.stats.to_dict()
+    return result
+
+def _bundle_job(job):
+    latex_path, dest_dir, kwargs, cache_dir = job
+    parse_cache = _batch_cache
+    if (parse_cache is None) and cache_dir:
+        parse_cache = ParseCache(cache_dir, read_only = True)
+    return run_bundle(latex_path, dest_dir, parse_cache = parse_cache,
+            **kwargs)
+
+def bundle_batch(jobs, processes = None, parse_cache = None, **kwargs):
+    """
+    Bundle each `(latex path, destination directory)` of `jobs` with its
+    own `SubmissionBundler` (created with `kwargs`) on a pool of
+    `processes` processes, and return a list of result dictionaries
+    ('latex_path', 'dest_dir', 'copied', 'failed', 'error', 'stats').
+
+    All documents are scanned in this process first, so that files they
+    share (macros, classes, bibliographies) are parsed once; the workers
+    then use `parse_cache` read-only.
+    """
+    jobs = [(expand_path(p), expand_path(d or os.path.join(
+            os.path.dirname(expand_path(p)), 'submit'))) for p, d in jobs]
+    dests = {}
+    for latex_path, dest_dir in jobs:
+        if dest_dir in dests:
+            raise Exception('{0!r} and {1!r} would both be bundled to '
+                    '{2!r}'.format(dests[dest_dir], latex_path, dest_dir))
+        dests[dest_dir] = latex_path
+    cache_dir = None
+    if parse_cache:
+        for latex_path, dest_dir in jobs:
+            DocumentGraph(latex_path, cache = parse_cache).build()
+        parse_cache.save()
+        cache_dir = parse_cache.cache_dir
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    tasks = [(p, d, kwargs, cache_dir) for p, d in jobs]
+    with _WorkerPool(processes, parse_cache) as pool:
+        return pool.map(_bundle_job, tasks, chunksize = 1)
+
+def format_batch_report(results):
+    """
+    Return the results of `bundle_batch` as a plain-text report.
+    """
+    lines = []
+    total_copied = 0
+    total_failed = 0
+    errors = 0
+    for r in results:
+        total_copied += len(r['copied'])
+        total_failed += len(r['failed'])
+        if r['error']:
+            errors += 1
+            lines.append('{0} -> {1}: ERROR: {2}'.format(r['latex_path'],
+                    r['dest_dir'], r['error']))
+            continue
+        lines.append('{0} -> {1}: {2} copied, {3} failed'.format(
+                r['latex_path'], r['dest_dir'], len(r['copied']),
+                len(r['failed'])))
+        for p in r['failed']:
+            lines.append('\tfailed: {0}'.format(p))
+    lines.append('{0} documents: {1} files copied, {2} failed, {3} '
+            'documents with errors'.format(len(results), total_copied,
+            total_failed, errors))
+    return '\n'.join(lines) + '\n'
+
+profile_options = ('strip_comments', 'append_figure_names', 'strip_si',
+        'strip_figures', 'exclude_caption_setup', 'merge', 'prune_bib')
+
+def parse_target(value):
+    """
+    Return the profile of `--target` value `value`: 'DEST_DIR' or
+    'DEST_DIR:OPTION,...', where each option is one of `profile_options`
+    (with dashes for underscores) to turn on, or to turn off if prefixed by
+    'no-' (e.g., 'si:strip-si,no-merge').
+    """
+    profile = {'dest_dir': value}
+    if ':' in value:
+        dest_dir, flags = value.rsplit(':', 1)
+        options = {}
+        for flag in flags.split(','):
+            flag = flag.strip()
+            k = flag.replace('-', '_')
+            on = not k.startswith('no_')
+            if not on:
+                k = k[3:]
+            if not k in profile_options:
+                options = None
+                break
+            options[k] = on
+        if options:
+            # otherwise, the colon is part of the path
+            profile = dict(options, dest_dir = dest_dir)
+    profile['dest_dir'] = expand_path(profile['dest_dir'])
+    return profile
+
+def bundle_profiles(latex_path, profiles, parse_cache = None,
+        read_workers = 1, **kwargs):
+    """
+    Bundle `latex_path` once for each of `profiles` and return a list of
+    result dictionaries as `run_bundle` does.
+
+    Each profile is a dictionary of the 'dest_dir' and of the options of
+    its `SubmissionBundler` (e.g., 'strip_si', 'strip_figures', 'merge')
+    that differ from `kwargs`. The document is scanned and read once for
+    all profiles, and each asset is copied once: the other bundles hard
+    link to that copy where they can.
+    """
+    latex_path = expand_path(latex_path)
+    dests = set()
+    for profile in profiles:
+        if profile['dest_dir'] in dests:
+            raise Exception('Several targets are bundled to {0!r}'.format(
+                    profile['dest_dir']))
+        dests.add(profile['dest_dir'])
+    graph = DocumentGraph(latex_path,
+            cache = parse_cache,
+            workers = read_workers,
+            keep_contents = True).build()
+    shared_assets = {}
+    results = []
+    for profile in profiles:
+        options = dict(kwargs)
+        options.update(profile)
+        dest_dir = options.pop('dest_dir')
+        results.append(run_bundle(latex_path, dest_dir,
+                parse_cache = parse_cache,
+                read_workers = read_workers,
+                graph = graph,
+                shared_assets = shared_assets,
+                **options))
+    return results
+
+def _mirror_job(task):
+    mirror, path = task
     try:
-        return content_iter.next()
-    except StopIteration:
+        assets, missing, state = mirror.mirror_file(path)
+    except Exception, e:
+        _LOG.error('Could not mirror {0!r}: {1}'.format(path, e))
+        return path, [], [], None, str(e)
+    return path, assets, missing, state, None
+
+def _mirror_asset_job(task):
+    mirror, path = task
+    try:
+        return path, mirror.copy_asset(path), None
+    except EnvironmentError, e:
+        _LOG.error('Could not copy {0!r}: {1}'.format(path, e))
+        return path, False, str(e)
+
+class TreeMirror(object):
+    """
+    Copies every LaTeX file under `src_root` to the same place under
+    `dest_root`, rewriting its relative paths for the new location.
+
+    Paths are resolved as when bundling: relative to the directory of the
+    root document (a file with a `\\documentclass`) that inputs the file
+    (`base_dirs`), or to the directory of the file if no root does. Paths
+    to other LaTeX files of the tree point to their copies, as do paths to
+    the other files under `src_root` if `copy_assets` is set (these assets
+    are then copied too); all other paths point to the original files.
+    Files are rewritten on a pool of `processes` processes. The sources of
+    the last mirror are recorded in `dest_root` (`manifest_name`), and files
+    that have not changed since are skipped; the mirrors of files that have
+    been deleted, or of assets no longer referred to, are removed.
+
+    Only changes to a LaTeX file itself (its size, modification time and
+    root directory) are detected: a file is not rewritten when only the
+    files it refers to change, even where that changes how its paths are
+    resolved (e.g. an asset was added, so a path now points to its copy),
+    and its mirror stays stale until the file is touched or the manifest
+    is deleted. Assets themselves are re-copied whenever they change.
+    """
+    manifest_name = '.subtex-mirror.json'
+
+    def __init__(self, src_root, dest_root,
+            copy_assets = False,
+            strip_comments = False,
+            processes = None,
+            parse_cache = None):
+        self.src_root = expand_path(src_root)
+        self.dest_root = expand_path(dest_root)
+        if self.src_root == self.dest_root:
+            raise Exception('Cannot mirror {0!r} onto itself'.format(
+                    self.src_root))
+        self.copy_assets = copy_assets
+        self.strip_comments = strip_comments
+        self.processes = processes
+        self.parse_cache = parse_cache
+        self.manifest_path = os.path.join(self.dest_root, self.manifest_name)
+        self.sources = set()
+        self.base_dirs = {}
+
+    def __getstate__(self):
+        # workers use the parse cache shared by `_WorkerPool`
+        state = dict(self.__dict__)
+        state.update(parse_cache = None)
+        return state
+
+    def get_options(self):
+        return {'version': _program_info['version'],
+                'copy_assets': self.copy_assets,
+                'strip_comments': self.strip_comments}
+
+    def find_sources(self):
+        """
+        Return the real paths of the LaTeX files under `src_root`, leaving
+        out hidden directories and `dest_root`.
+        """
+        sources = set()
+        for d, dirs, files in os.walk(self.src_root):
+            dirs[:] = [x for x in dirs if (not x.startswith('.')) and
+                    (expand_path(os.path.join(d, x)) != self.dest_root)]
+            for f in files:
+                if f.endswith('.tex'):
+                    sources.add(expand_path(os.path.join(d, f)))
+        return sources
+
+    @classmethod
+    def is_root(cls, path):
+        """
+        Return whether LaTeX file `path` declares a `\\documentclass`
+        before its document body.
+        """
+        pattern = SubmissionBundler.path_patterns['documentclass']
+        with open(path, 'rU') as stream:
+            for line in stream:
+                if ('\\documentclass' in line) and pattern.match(line):
+                    return True
+                if SubmissionBundler.begin_document_pattern.match(line):
+                    break
+        return False
+
+    def find_base_dirs(self):
+        """
+        Return the directory that the paths of each LaTeX file of the tree
+        are relative to, for the files input by a root document.
+        """
+        base_dirs = {}
+        for path in sorted(self.sources):
+            try:
+                if not self.is_root(path):
+                    continue
+            except EnvironmentError, e:
+                _LOG.warning('Could not read {0!r}: {1}'.format(path, e))
+                continue
+            graph = DocumentGraph(path, cache = self.parse_cache).build()
+            for p in graph.nodes:
+                if graph.nodes[p].kind == 'tex':
+                    base_dirs.setdefault(p, graph.base_dirs.get(p,
+                            graph.latex_dir))
+        return base_dirs
+
+    def get_base_dir(self, path):
+        return self.base_dirs.get(path, os.path.dirname(path))
+
+    def get_rel_base_dir(self, path):
+        return os.path.relpath(self.get_base_dir(path), self.src_root)
+
+    def is_inside(self, path):
+        return path.startswith(self.src_root + os.sep)
+
+    def get_mirror_path(self, path):
+        if (path != self.src_root) and (not self.is_inside(path)):
+            return path
+        return os.path.normpath(os.path.join(self.dest_root,
+                os.path.relpath(path, self.src_root)))
+
+    def get_source(self, k, path):
+        """
+        Return the file that `path` (matched by pattern `k`) refers to, or
+        `None` if it does not exist (e.g., a class that is not local).
+        """
+        if k == 'input':
+            candidates = [path, path + '.tex']
+        else:
+            candidates = [SubmissionBundler.get_source_path(k, path, '')[0]]
+        for p in candidates:
+            if os.path.isfile(p):
+                return p
+        if (k == 'graphic') or (k in SubmissionBundler.custom_fig_path_patterns):
+            return GraphicsResolver(os.path.dirname(path)).resolve(
+                    os.path.basename(path))
         return None
 
-def top_level_content_iter(string, start='{', end='}'):
-    delim = re.compile('([' + start + end + '])')
-    start_index = string.find(start)
-    nested_level = 0
-    if start_index == -1:
-        return
-    search_index = None
-    for s in delim.finditer(string[start_index:]):
-        d = s.groups()[0]
-        delim_index = s.start() + start_index
-        if d == start:
-            nested_level += 1
-            if nested_level == 1:
-                search_index = delim_index
+    def mirror_file(self, path):
+        """
+        Mirror LaTeX file `path` and return the assets to copy with it, the
+        figures and inputs it refers to that do not exist, and the state of
+        its `DocumentNode`.
+        """
+        assets = set()
+        missing = set()
+        def relocate(k, p):
+            src = self.get_source(k, p)
+            if src is None:
+                if (k == 'input') or (k == 'graphic') or (
+                        k in SubmissionBundler.custom_fig_path_patterns):
+                    missing.add(p)
+                return None
+            if not self.is_inside(src):
+                return p
+            if src in self.sources:
+                return self.get_mirror_path(p)
+            if self.copy_assets:
+                assets.add(src)
+                return self.get_mirror_path(p)
+            return p
+        dest_path = self.get_mirror_path(path)
+        mkdr(os.path.dirname(dest_path))
+        graph = DocumentGraph(path, cache = _batch_cache)
+        base_dir = self.get_base_dir(path)
+        copy_latex_file(path, dest_path,
+                over_write = True,
+                strip_comments = self.strip_comments,
+                graph = graph,
+                relocate = relocate,
+                base_dir = base_dir,
+                dest_base_dir = self.get_mirror_path(base_dir))
+        return (sorted(assets), sorted(missing),
+                graph.get_node(path).get_state())
+
+    def copy_asset(self, path):
+        """
+        Copy asset `path` to its mirror unless the mirror is up to date;
+        return whether it was copied.
+        """
+        dest_path = self.get_mirror_path(path)
+        st = os.stat(path)
+        if os.path.exists(dest_path):
+            dest_st = os.stat(dest_path)
+            # `copy2` keeps the mtime, up to the precision of the file system
+            if (dest_st.st_size == st.st_size) and (
+                    int(dest_st.st_mtime) >= int(st.st_mtime)):
+                return False
+        mkdr(os.path.dirname(dest_path))
+        shutil.copy2(path, dest_path)
+        return True
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'rU') as stream:
+                return json.load(stream)
+        except ValueError, e:
+            _LOG.warning('Ignoring invalid mirror manifest {0!r}: {1}'.format(
+                    self.manifest_path, e))
+            return {}
+
+    def remove_orphans(self, previous, files, assets):
+        """
+        Remove the mirrors of the LaTeX files and assets recorded in the
+        `previous` manifest entries that are neither in `files` (the entries
+        of this mirror) nor in `assets`, and return their paths relative to
+        `src_root`.
+        """
+        kept = set(files)
+        kept.update(os.path.relpath(p, self.src_root) for p in assets)
+        orphans = set(previous)
+        for entry in previous.itervalues():
+            orphans.update(entry[2])
+        removed = []
+        for rel_path in sorted(orphans - kept):
+            path = os.path.normpath(os.path.join(self.src_root, rel_path))
+            if not self.is_inside(path):
+                continue
+            dest_path = self.get_mirror_path(path)
+            if not os.path.isfile(dest_path):
+                continue
+            try:
+                os.remove(dest_path)
+            except EnvironmentError, e:
+                _LOG.warning('Could not remove {0!r}: {1}'.format(dest_path,
+                        e))
+                continue
+            removed.append(rel_path)
+        return removed
+
+    def is_current(self, path, st, entry):
+        """
+        Return True if the mirror of `path` (with `os.stat` result `st`) is
+        up to date with its manifest `entry` (`[mtime, size, asset paths,
+        root directory, missing paths]`), which may be `None`. A file is
+        mirrored again if a file it referred to that was missing has
+        appeared since.
+        """
+        if (not entry) or (len(entry) != 5):
+            return False
+        mtime, size, assets, rel_base_dir, missing = entry
+        if (mtime != st.st_mtime) or (size != st.st_size) or (
+                rel_base_dir != self.get_rel_base_dir(path)):
+            return False
+        if not os.path.exists(self.get_mirror_path(path)):
+            return False
+        return not [p for p in missing if os.path.exists(p)]
+
+    def write_manifest(self, files):
+        m = {'options': self.get_options(),
+             'files': files}
+        with open(self.manifest_path, 'w') as stream:
+            json.dump(m, stream, indent = 1, sort_keys = True)
+
+    def run(self):
+        """
+        Mirror the tree and return a dictionary of the 'src_root',
+        'dest_root', the LaTeX files 'written', the number 'skipped', the
+        'assets' copied, the mirrored files 'removed' because their source
+        was deleted or is no longer referred to, and the 'errors' (`[path,
+        message]` lists). Paths are relative to `src_root`.
+        """
+        self.sources = self.find_sources()
+        self.base_dirs = self.find_base_dirs()
+        manifest = self.read_manifest()
+        previous = {}
+        if manifest.get('options', None) == self.get_options():
+            previous = manifest.get('files', {})
+        files = {}
+        assets = set()
+        tasks = []
+        skipped_missing = []
+        for path in sorted(self.sources):
+            rel_path = os.path.relpath(path, self.src_root)
+            st = os.stat(path)
+            entry = previous.get(rel_path, None)
+            if self.is_current(path, st, entry):
+                files[rel_path] = entry
+                assets.update(os.path.join(self.src_root, p)
+                        for p in entry[2])
+                skipped_missing.extend((rel_path, p) for p in entry[4])
+            else:
+                tasks.append((self, path))
+        report = {'src_root': self.src_root,
+                  'dest_root': self.dest_root,
+                  'written': [],
+                  'skipped': len(files),
+                  'assets': [],
+                  'removed': [],
+                  'errors': []}
+        for rel_path, p in skipped_missing:
+            # read back from JSON as unicode
+            report['errors'].append([rel_path, 'refers to missing file '
+                    '{0!r}'.format(p.encode('utf-8'))])
+        processes = self.processes
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, len(tasks) + len(assets)))
+        parse_cache = self.parse_cache
+        with _WorkerPool(processes, parse_cache) as pool:
+            for path, file_assets, missing, state, error in pool.map(
+                    _mirror_job, tasks):
+                rel_path = os.path.relpath(path, self.src_root)
+                if error:
+                    report['errors'].append([rel_path, error])
+                    continue
+                for p in missing:
+                    report['errors'].append([rel_path, 'refers to missing '
+                            'file {0!r}'.format(p)])
+                report['written'].append(rel_path)
+                st = os.stat(path)
+                files[rel_path] = [st.st_mtime, st.st_size,
+                        [os.path.relpath(p, self.src_root)
+                                for p in file_assets],
+                        self.get_rel_base_dir(path), sorted(missing)]
+                assets.update(file_assets)
+                if parse_cache:
+                    parse_cache.put(DocumentNode.from_state(path, state))
+            for path, copied, error in pool.map(_mirror_asset_job,
+                    [(self, p) for p in sorted(assets)]):
+                rel_path = os.path.relpath(path, self.src_root)
+                if error:
+                    report['errors'].append([rel_path, error])
+                elif copied:
+                    report['assets'].append(rel_path)
+        report['removed'] = self.remove_orphans(manifest.get('files', {}),
+                files, assets)
+        if parse_cache:
+            parse_cache.save()
+        # the mirror must be self-contained
+        failed = set(p for p, error in report['errors'])
+        for path in sorted(assets):
+            rel_path = os.path.relpath(path, self.src_root)
+            if (not rel_path in failed) and (not os.path.isfile(
+                    self.get_mirror_path(path))):
+                report['errors'].append([rel_path, 'missing from the mirror'])
+        mkdr(self.dest_root)
+        self.write_manifest(files)
+        return report
+
+def format_mirror_report(report):
+    """
+    Return the result of `TreeMirror.run` as a plain-text report.
+    """
+    lines = ['{0} -> {1}: {2} LaTeX files written, {3} unchanged, {4} '
+            'assets copied, {5} removed'.format(report['src_root'],
+            report['dest_root'], len(report['written']), report['skipped'],
+            len(report['assets']), len(report.get('removed', [])))]
+    for p, error in report['errors']:
+        lines.append('\tERROR: {0}: {1}'.format(p, error))
+    return '\n'.join(lines) + '\n'
+
+class LatencyMetrics(object):
+    """
+    Counts and durations of jobs; percentiles are computed over the last
+    `size` jobs.
+    """
+    def __init__(self, size = 1000):
+        self.durations = deque(maxlen = size)
+        self.jobs = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def add(self, seconds, error = False):
+        self.durations.append(seconds)
+        self.jobs += 1
+        self.total_seconds += seconds
+        if error:
+            self.errors += 1
+
+    def get_percentile(self, durations, q):
+        if not durations:
+            return None
+        return durations[min(len(durations) - 1, int(q * len(durations)))]
+
+    def summary(self):
+        d = sorted(self.durations)
+        mean = None
+        if self.jobs:
+            mean = self.total_seconds / self.jobs
+        last = None
+        if self.durations:
+            last = self.durations[-1]
+        return {'jobs': self.jobs,
+                'errors': self.errors,
+                'total_seconds': self.total_seconds,
+                'mean_seconds': mean,
+                'p50_seconds': self.get_percentile(d, 0.5),
+                'p90_seconds': self.get_percentile(d, 0.9),
+                'p99_seconds': self.get_percentile(d, 0.99),
+                'max_seconds': (d[-1] if d else None),
+                'last_seconds': last}
+
+class BundleService(object):
+    """
+    Runs bundle jobs in a long-lived process.
+
+    Every job gets a new `SubmissionBundler`, so nothing is carried from one
+    job to the next except `parse_cache`: the scanned LaTeX files and asset
+    digests, each bounded to the `max_entries` most recently used. Jobs
+    are run one at a time, and the latency of each is recorded in
+    `metrics`. `defaults` are keyword arguments of `SubmissionBundler` used
+    for options a job does not set. `job_options` maps the options a job
+    may set to their type.
+    """
+    job_options = {'strip_comments': bool,
+                   'append_figure_names': bool,
+                   'strip_si': bool,
+                   'strip_figures': bool,
+                   'exclude_caption_setup': bool,
+                   'merge': bool,
+                   'copy_workers': int,
+                   'copy_strategy': str,
+                   'incremental': bool,
+                   'dedup_assets': bool,
+                   'collect_stats': bool,
+                   'read_workers': int,
+                   'prune_bib': bool}
+    path_options = ('latex_path', 'dest_dir', 'archive')
+
+    def __init__(self, parse_cache = None, defaults = None):
+        self.parse_cache = parse_cache
+        self.defaults = dict(defaults or {})
+        self.metrics = LatencyMetrics()
+        self.lock = threading.Lock()
+
+    def get_job_arguments(self, job):
+        """
+        Return the LaTeX path, destination and `SubmissionBundler` keyword
+        arguments of `job`, or raise `ValueError` if it is not valid.
+        """
+        if not isinstance(job, dict):
+            raise ValueError('A job must be a JSON object')
+        if not job.get('latex_path', None):
+            raise ValueError('A job requires a latex_path')
+        # paths and names must be byte strings, like the lines they are
+        # written into
+        encoding = sys.getfilesystemencoding() or 'utf-8'
+        job = dict((str(k), (v.encode(encoding) if isinstance(v, unicode)
+                else v)) for k, v in job.iteritems())
+        kwargs = dict(self.defaults)
+        for k, v in job.iteritems():
+            if k in self.job_options:
+                kwargs[k] = self.check_option(k, v, self.job_options[k])
+            elif k in self.path_options:
+                if not v is None:
+                    self.check_option(k, v, str)
+            else:
+                raise ValueError('Unknown job option {0!r}'.format(k))
+        latex_path = expand_path(job['latex_path'])
+        dest_dir = job.get('dest_dir', None) or os.path.join(
+                os.path.dirname(latex_path), 'submit')
+        if job.get('archive', None):
+            kwargs['sink'] = get_sink(expand_path(job['archive']))
+        kwargs['parse_cache'] = self.parse_cache
+        return latex_path, expand_path(dest_dir), kwargs
+
+    @classmethod
+    def check_option(cls, name, value, option_type):
+        """
+        Return `value`, the value of job option `name`, if it is of
+        `option_type` (and valid for that option), and raise `ValueError`
+        otherwise.
+        """
+        # bool is a subclass of int, but not a number of workers
+        if (not isinstance(value, option_type)) or (
+                (option_type is int) and isinstance(value, bool)):
+            raise ValueError('Job option {0!r} must be {1}, not {2!r}'.format(
+                    name, {bool: 'true or false', int: 'an integer',
+                            str: 'a string'}[option_type], value))
+        if (option_type is int) and (value < 1):
+            raise ValueError('Job option {0!r} must be at least 1, not '
+                    '{1!r}'.format(name, value))
+        if (name == 'copy_strategy') and (
+                not value in AssetCopier.strategies):
+            raise ValueError('Job option {0!r} must be one of {1}, not '
+                    '{2!r}'.format(name, ', '.join(AssetCopier.strategies),
+                            value))
+        return value
+
+    def run_job(self, job):
+        """
+        Bundle the document described by dictionary `job` and return the
+        result of `run_bundle`, with the duration of the job as 'seconds'.
+
+        A job has a 'latex_path' and optionally a 'dest_dir' (default: a
+        'submit' directory next to the LaTeX file), an 'archive' to write
+        instead, and any of the `SubmissionBundler` options in
+        `job_options`.
+        """
+        latex_path, dest_dir, kwargs = self.get_job_arguments(job)
+        with self.lock:
+            start = time.time()
+            result = run_bundle(latex_path, dest_dir, **kwargs)
+            result['seconds'] = time.time() - start
+            self.metrics.add(result['seconds'], bool(result['error']))
+        return result
+
+    def get_metrics(self):
+        m = {'latency': self.metrics.summary()}
+        if self.parse_cache:
+            m['parse_cache'] = {'files': len(self.parse_cache.states),
+                    'digests': len(self.parse_cache.digests),
+                    'max_entries': self.parse_cache.max_entries}
+        return m
+
+class BundleRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP front end of the `BundleService` of its server: `POST /bundle`
+    with a JSON job runs it and returns the JSON result, and `GET /metrics`
+    returns the service metrics.
+    """
+    server_version = 'subtex/{0}'.format(_program_info['version'])
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, indent = 1, sort_keys = True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        self.send_json(200, self.server.service.get_metrics())
+
+    def do_POST(self):
+        if self.path != '/bundle':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length))
+            result = self.server.service.run_job(job)
+        except ValueError, e:
+            self.send_json(400, {'error': str(e)})
+            return
+        if result['error']:
+            self.send_json(500, result)
         else:
-            nested_level -= 1
-            if nested_level == 0:
-                yield string[search_index + 1: delim_index]
+            self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        _LOG.info('{0} - {1}'.format(self.address_string(), format % args))
+
+def serve(service, host = '127.0.0.1', port = 8000):
+    """
+    Serve `service` over HTTP on `host`:`port` until interrupted.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), BundleRequestHandler)
+    server.service = service
+    _LOG.warning('Serving bundle jobs on http://{0}:{1}/'.format(
+            *server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if service.parse_cache:
+            service.parse_cache.save()
+
+def write_profile(profiler, path):
+    profiler.disable()
+    if path == '-':
+        import pstats
+        pstats.Stats(profiler, stream = sys.stderr).sort_stats(
+                'cumulative').print_stats(30)
+    else:
+        profiler.dump_stats(path)
 
 def main():
     from optparse import OptionParser
     description = '{name} {version}'.format(**_program_info)
-    usage = "\n  %prog [options] <LATEX_FILE_PATH>"
+    usage = ("\n  %prog [options] <LATEX_FILE_PATH>"
+             "\n  %prog [options] <LATEX_FILE_PATH> <LATEX_FILE_PATH> ..."
+             "\n  %prog [options] --batch <BATCH_FILE>"
+             "\n  %prog [options] --stdout - < <LATEX_FILE_PATH>"
+             "\n  %prog [options] --serve [HOST:]PORT")
     parser = OptionParser(usage=usage, description=description,
                           version=_program_info['version'],
                           add_help_option=True)
@@ -517,17 +4269,178 @@ def main():
     parser.add_option("--merge", dest="merge",
             default=False,
             action="store_true",
-            help=("Merge all content into a single LaTeX file."))
+            help=("Merge all content into a single LaTeX file, "
+                    "flattening `input`, `include`, `subfile`, `import` and "
+                    "`subimport`."))
+    parser.add_option("--copy-strategy", dest="copy_strategy",
+            type="choice",
+            choices=list(AssetCopier.strategies),
+            default='copy',
+            help=("How to transfer figures and other files to the "
+                  "submission directory: 'copy', 'link' (hard link), "
+                  "'reflink' (copy-on-write clone) or 'sendfile'. Strategies "
+                  "fall back to 'copy' where unsupported. Default: 'copy'."))
+    parser.add_option("--copy-workers", dest="copy_workers", type="int",
+            default=4,
+            help=("Number of threads used to copy files. Default: 4."))
+    parser.add_option("--target", dest="targets", action="append",
+            default=[],
+            help=("Bundle the document into this directory; may be given "
+                  "several times to bundle several versions of the document "
+                  "(e.g., main text and SI) from a single scan, sharing "
+                  "copied figures. Options of a target can follow the "
+                  "directory after a colon, comma separated: strip-si, "
+                  "strip-figures, merge, append-figure-names, "
+                  "exclude-caption-setup, strip-comments, prune-bib, each "
+                  "optionally prefixed by no- (e.g., "
+                  "main:strip-figures --target si:strip-si)."))
+    parser.add_option("--read-workers", dest="read_workers", type="int",
+            default=1,
+            help=("Number of threads used to read the LaTeX files of the "
+                  "document ahead of bundling them (e.g., on network file "
+                  "systems). Output does not depend on it. Default: 1 "
+                  "(read each file when it is bundled)."))
+    parser.add_option("--incremental", dest="incremental", default=False,
+            action="store_true",
+            help=("Keep a manifest in the submission directory and only "
+                  "rewrite or recopy files that changed since the last "
+                  "bundle made with the same options."))
+    parser.add_option("--watch", dest="watch", default=False,
+            action="store_true",
+            help=("Bundle, then keep watching the files the document uses "
+                  "and update the submission directory when they change. "
+                  "Implies --incremental."))
+    parser.add_option("--watch-interval", dest="watch_interval",
+            type="float",
+            default=1.0,
+            help=("Seconds between checks for changes when inotify is not "
+                  "available to --watch. Default: 1."))
+    parser.add_option("--cache-dir", dest="cache_dir", default=None,
+            help=("Directory of the cache of parsed LaTeX files, which is "
+                  "read and updated on every run unless --no-cache is "
+                  "given. Default: $SUBTEX_CACHE_DIR or "
+                  "$XDG_CACHE_HOME/subtex (~/.cache/subtex)."))
+    parser.add_option("--no-cache", dest="no_cache", default=False,
+            action="store_true",
+            help=("Do not read or write the cache of parsed LaTeX files."))
+    parser.add_option("--archive", dest="archive", default=None,
+            help=("Write the submission into this zip (.zip) or tar (.tar, "
+                  ".tar.gz, .tgz, .tar.bz2) archive instead of the 'submit' "
+                  "directory."))
+    parser.add_option("--prune-bib", dest="prune_bib", default=False,
+            action="store_true",
+            help=("Only include the cited entries (and the entries they "
+                  "cross-reference) of bibliography files. Bibliographies "
+                  "are included whole if the document uses \\nocite{*}."))
+    parser.add_option("--dedup-figures", dest="dedup_figures", default=False,
+            action="store_true",
+            help=("Compare figure files by content: identical figures are "
+                  "copied once (and share a figure number), and different "
+                  "figures with the same file name are renamed instead of "
+                  "causing an error."))
+    parser.add_option("--raster-max-size", dest="raster_max_size",
+            type="int", default=None, metavar="PIXELS",
+            help=("Scale rasterized figures (the PNG, JPEG or TIFF files "
+                  "of \\ifuserasterizedplots figures) down so that their "
+                  "longest side is at most this many pixels, and recompress "
+                  "them. Requires the Python Imaging Library (Pillow)."))
+    parser.add_option("--raster-dpi", dest="raster_dpi", type="float",
+            default=None,
+            help=("Scale rasterized figures down to at most this resolution "
+                  "(for images that record one) and recompress them. "
+                  "Requires the Python Imaging Library (Pillow)."))
+    parser.add_option("--raster-quality", dest="raster_quality", type="int",
+            default=85,
+            help=("JPEG quality of resampled figures. Default: 85."))
+    parser.add_option("--raster-workers", dest="raster_workers", type="int",
+            default=None,
+            help=("Number of processes used to resample figures. Default: "
+                  "the number of CPUs."))
+    parser.add_option("--raster-cache-size", dest="raster_cache_size",
+            type="int", default=500,
+            help=("Maximum size in MB of the cache of resampled figures; "
+                  "the least recently used are removed first. Default: "
+                  "500."))
     parser.add_option("--cp", dest="cp", default=False,
             action="store_true",
-            help=("Only copy the latex file and update its paths."))
+            help=("Only copy the latex file and update its paths. If the "
+                  "source is a directory, copy every latex file under it to "
+                  "the same place under the destination directory, skipping "
+                  "files unchanged since the last copy."))
+    parser.add_option("--stdout", dest="stdout", default=False,
+            action="store_true",
+            help=("Write the bundled document to stdout (implies --merge). "
+                  "Files are not copied, but listed with --asset-list."))
+    parser.add_option("--asset-list", dest="asset_list", default=None,
+            help=("With --stdout, list the files of the bundle (one JSON "
+                  "object per line: name, source, kind, size) to this file, "
+                  "or to an open file descriptor given as fd:N (e.g., "
+                  "fd:3)."))
+    parser.add_option("--stdin-name", dest="stdin_name", default="stdin.tex",
+            help=("Path of the document read from stdin when the LaTeX "
+                  "file is given as '-' (with --cp, also as destination); "
+                  "its relative paths are relative to this path. Default: "
+                  "stdin.tex in the current directory."))
+    parser.add_option("--cp-assets", dest="cp_assets", default=False,
+            action="store_true",
+            help=("With --cp on a directory, also copy the files under it "
+                  "that the latex files refer to."))
+    parser.add_option("--stats", dest="stats", default=None,
+            type="choice",
+            choices=['text', 'json'],
+            help=("Print timings and counts for each phase of the bundle "
+                  "(parsing, bundling each file, parsing captions, copying) "
+                  "as text (--stats) or JSON (--stats=json)."))
+    parser.add_option("--batch", dest="batch", default=None,
+            help=("Bundle every document listed in this file, one per line: "
+                  "the path of the main LaTeX file, optionally followed by "
+                  "the destination directory. Documents given as arguments "
+                  "are bundled too."))
+    parser.add_option("--jobs", dest="jobs", type="int", default=None,
+            help=("Number of processes used to bundle several documents, "
+                  "or to copy a directory with --cp. Default: the number of "
+                  "CPUs."))
+    parser.add_option("--plan", dest="plan", default=None,
+            type="choice",
+            choices=['text', 'json'],
+            help=("Do not write anything; print the files the bundle would "
+                  "contain, their sources and sizes, missing sources and "
+                  "name collisions as text (--plan) or JSON (--plan=json). "
+                  "Exits with 1 if files are missing or collide. Sources "
+                  "are only stat'ed, except that figures are hashed with "
+                  "--dedup-figures."))
+    parser.add_option("--serve", dest="serve", default=None,
+            metavar="[HOST:]PORT",
+            help=("Keep running and bundle the jobs POSTed as JSON to "
+                  "http://HOST:PORT/bundle (default host: 127.0.0.1), "
+                  "keeping scanned files cached between jobs. Job latency "
+                  "is reported at /metrics. Other options set the defaults "
+                  "of each job."))
+    parser.add_option("--cache-entries", dest="cache_entries", type="int",
+            default=20000,
+            help=("Maximum number of files (and of asset digests) kept in "
+                  "the cache of parsed LaTeX files. Default: 20000."))
+    parser.add_option("--profile", dest="profile", default=None,
+            help=("Profile the whole run with cProfile and write the "
+                  "profile to this file ('-' prints a summary to stderr)."))
     parser.add_option("-v", "--verbose", dest="verbose", default=False, 
             action="store_true",
             help="Verbose output.")
     parser.add_option("-d", "--debugging", dest="debugging", default=False, 
             action="store_true",
             help="Run in debugging mode.")
-    (options, args) = parser.parse_args()
+    # optparse options cannot have optional values; a bare '--stats' or
+    # '--plan' means the text report
+    argv = [({'--stats': '--stats=text', '--plan': '--plan=text'}.get(a, a))
+            for a in sys.argv[1:]]
+    (options, args) = parser.parse_args(argv)
+
+    if options.profile:
+        import atexit
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(write_profile, profiler, options.profile)
+        profiler.enable()
 
     if options.debugging:
         _LOG.setLevel(logging.DEBUG)
@@ -536,40 +4449,229 @@ def main():
     else:
         _LOG.setLevel(logging.WARNING)
     
+    parse_cache = None
+    if not options.no_cache:
+        parse_cache = ParseCache(options.cache_dir,
+                max_entries = options.cache_entries)
+
     if options.cp:
         if len(args) != 2:
             _LOG.error("To copy a file, you must specify the source and "
                     "destination path.")
             sys.stderr.write(str(parser.print_help()))
             sys.exit(-1)
-        copy_latex_file(args[0], args[1],
-                strip_comments = (not options.preserve_comments))
+        if os.path.isdir(args[0]):
+            mirror = TreeMirror(args[0], args[1],
+                    copy_assets = options.cp_assets,
+                    strip_comments = (not options.preserve_comments),
+                    processes = options.jobs,
+                    parse_cache = parse_cache)
+            report = mirror.run()
+            sys.stdout.write(format_mirror_report(report))
+            if report['errors']:
+                sys.exit(1)
+            sys.exit(0)
+        latex_path, dest_path = args
+        latex_text = None
+        out = None
+        if latex_path == '-':
+            latex_path = options.stdin_name
+            latex_text = read_text_stream(sys.stdin)
+        if dest_path == '-':
+            dest_path = os.curdir
+            out = sys.stdout
+        copy_latex_file(latex_path, dest_path,
+                strip_comments = (not options.preserve_comments),
+                graph = DocumentGraph(latex_path, cache = parse_cache),
+                latex_text = latex_text,
+                out = out)
+        if parse_cache:
+            parse_cache.save()
         sys.exit(0)
 
-    if len(args) != 1:
+    if (not args) and (not options.batch) and (not options.serve):
         _LOG.error("Program requires path to main latex file")
         sys.stderr.write(str(parser.print_help()))
         sys.exit(-1)
 
+    if options.archive and (options.incremental or options.watch):
+        _LOG.error("--archive cannot be used with --incremental or --watch")
+        sys.exit(-1)
+
+    raster_transformer = None
+    if options.raster_max_size or options.raster_dpi:
+        raster_dir = None
+        if parse_cache:
+            # resampled figures are cached next to the parse cache
+            raster_dir = os.path.join(parse_cache.cache_dir, 'rasters')
+        try:
+            raster_transformer = RasterTransformer(raster_dir,
+                    max_size = options.raster_max_size,
+                    dpi = options.raster_dpi,
+                    quality = options.raster_quality,
+                    processes = options.raster_workers,
+                    max_cache_bytes = options.raster_cache_size << 20)
+        except Exception, e:
+            _LOG.error(str(e))
+            sys.exit(-1)
+        import atexit
+        atexit.register(raster_transformer.close)
+
+    bundler_options = dict(
+            strip_comments = not options.preserve_comments,
+            append_figure_names = options.append_figure_names,
+            strip_si = options.strip_si,
+            strip_figures = options.strip_figures,
+            exclude_caption_setup = options.exclude_caption_setup,
+            merge = options.merge,
+            copy_workers = options.copy_workers,
+            copy_strategy = options.copy_strategy,
+            incremental = options.incremental,
+            dedup_assets = options.dedup_figures,
+            collect_stats = bool(options.stats),
+            raster_transformer = raster_transformer,
+            read_workers = options.read_workers,
+            prune_bib = options.prune_bib)
+
+    latex_text = None
+    if options.stdout or (args == ['-']):
+        if (options.batch or options.targets or options.plan or
+                options.serve or options.watch or options.incremental or
+                options.archive or (len(args) != 1)):
+            _LOG.error("Reading from stdin and --stdout require a single "
+                    "document and cannot be used with --batch, --target, "
+                    "--plan, --serve, --watch, --incremental or --archive")
+            sys.exit(-1)
+        if args[0] == '-':
+            latex_text = read_text_stream(sys.stdin)
+            args = [options.stdin_name]
+        if options.stdout:
+            bundler_options['merge'] = True
+    elif options.asset_list:
+        _LOG.error("--asset-list requires --stdout")
+        sys.exit(-1)
+
+    if options.plan:
+        if (options.watch or options.incremental or options.serve or
+                options.targets):
+            _LOG.error("--plan cannot be used with --watch, --incremental, "
+                    "--serve or --target")
+            sys.exit(-1)
+        jobs = []
+        if options.batch:
+            jobs.extend(read_batch_file(options.batch))
+        jobs.extend((p, None) for p in args)
+        plans = []
+        for p, dest_dir in jobs:
+            latex_path = expand_path(p)
+            plans.append(plan_bundle(latex_path,
+                    dest_dir or os.path.join(os.path.dirname(latex_path),
+                            'submit'),
+                    parse_cache = parse_cache,
+                    **bundler_options))
+        if options.plan == 'json':
+            json.dump(plans if len(plans) > 1 else plans[0], sys.stdout,
+                    indent = 1, sort_keys = True)
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.write('\n'.join(format_plan(p) for p in plans))
+        if [p for p in plans if p['missing'] or p['collisions']]:
+            sys.exit(1)
+        sys.exit(0)
+
+    if options.serve:
+        host, sep, port = options.serve.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            _LOG.error("--serve requires a port number")
+            sys.exit(-1)
+        serve(BundleService(parse_cache = parse_cache,
+                        defaults = bundler_options),
+                host = (host or '127.0.0.1'),
+                port = port)
+        sys.exit(0)
+
+    if options.targets or options.batch or (len(args) > 1):
+        if options.archive or options.watch:
+            _LOG.error("--archive and --watch cannot be used with several "
+                    "documents or targets")
+            sys.exit(-1)
+        if options.targets:
+            if options.batch or (len(args) > 1):
+                _LOG.error("--target requires a single document")
+                sys.exit(-1)
+            try:
+                results = bundle_profiles(args[0],
+                        [parse_target(t) for t in options.targets],
+                        parse_cache = parse_cache,
+                        **bundler_options)
+            except Exception, e:
+                _LOG.error(str(e))
+                sys.exit(-1)
+        else:
+            jobs = []
+            if options.batch:
+                jobs.extend(read_batch_file(options.batch))
+            jobs.extend((p, None) for p in args)
+            results = bundle_batch(jobs,
+                    processes = options.jobs,
+                    parse_cache = parse_cache,
+                    **bundler_options)
+        if options.stats == 'json':
+            json.dump(results, sys.stdout, indent = 1, sort_keys = True)
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.write(format_batch_report(results))
+            if options.stats:
+                for r in results:
+                    if r['stats']:
+                        sys.stdout.write('\n{0}:\n'.format(r['latex_path']))
+                        sys.stdout.write(BundleStats.from_dict(
+                                r['stats']).format())
+        if [r for r in results if r['error'] or r['failed']]:
+            sys.exit(1)
+        sys.exit(0)
+
     latex_path = expand_path(args[0])
     project_dir = os.path.dirname(latex_path)
     submit_dir = os.path.join(project_dir, 'submit')
+    sink = None
+    report_stream = sys.stdout
+    if options.archive:
+        sink = get_sink(options.archive)
+    elif options.stdout:
+        asset_stream = None
+        if options.asset_list:
+            asset_stream = open_side_channel(options.asset_list)
+        sink = PipeSink(sys.stdout, os.path.basename(latex_path),
+                asset_stream = asset_stream)
+        report_stream = sys.stderr
     bundler = SubmissionBundler(
             latex_path = latex_path,
             dest_dir = submit_dir,
-            strip_comments = not options.preserve_comments,
-            append_figure_names = options.append_figure_names,
-            strip_si = options.strip_si,
-            strip_figures = options.strip_figures,
-            exclude_caption_setup = options.exclude_caption_setup,
-            merge = options.merge)
-    paths_copied, paths_failed = bundler.bundle()
+            parse_cache = parse_cache,
+            sink = sink,
+            latex_text = latex_text,
+            **bundler_options)
+    if options.watch:
+        BundleWatcher(bundler, interval = options.watch_interval).run()
+        sys.exit(0)
+    result = bundler.bundle()
+    paths_copied, paths_failed = result
+    if options.stats == 'json':
+        json.dump(result.stats.to_dict(), report_stream, indent = 1,
+                sort_keys = True)
+        report_stream.write('\n')
+    elif options.stats:
+        report_stream.write(result.stats.format())
     if paths_copied:
         _LOG.info('Files successfully copied:\n\t{0}\n'.format(
                 "\n\t".join(paths_copied)))
     if paths_failed:
         _LOG.info('Files that failed to be copied:\n\t{0}\n'.format(
                 "\n\t".join(paths_failed)))
+        sys.exit(1)
         
 if __name__ == '__main__':
     main()